@@ -0,0 +1,97 @@
+#%%
+import json
+import os
+import re
+import sqlite3
+import time
+
+#%%
+# fields stored for a validated address; Address3 is the caller's own ADDRESS2
+# value and is filled back in on lookup
+CACHED_FIELDS = ["Address2", "City", "State", "Zip5", "Zip4", "VALIDATION_ERROR"]
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_parts(address1, address2, city, zipcode):
+    # the address without case, repeated spaces and trailing periods
+    return tuple(_whitespace.sub(" ", str(value)).strip().rstrip(".").upper()
+                 for value in (address1, address2, city, zipcode))
+
+
+def normalize_address(address1, address2, city, zipcode):
+    # build a cache key that ignores case, repeated spaces and trailing periods
+    return "|".join(normalize_parts(address1, address2, city, zipcode))
+
+
+#%%
+class AddressCache:
+    """On-disk cache of USPS validation results keyed on a normalized address.
+
+    Entries older than `ttl` seconds are ignored and purged. Once the cache
+    holds more than `max_entries` rows the least recently used are evicted.
+    """
+
+    def __init__(self, path, ttl=90 * 24 * 3600, max_entries=1_000_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS addresses ("
+                          "key TEXT PRIMARY KEY, "
+                          "result TEXT NOT NULL, "
+                          "created REAL NOT NULL, "
+                          "accessed REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS addresses_accessed ON addresses (accessed)")
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """Return {key: result} for every key with a live cache entry."""
+        now = time.time()
+        found = {}
+        keys = list(keys)
+
+        # stay under SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(f"SELECT key, result FROM addresses "
+                                     f"WHERE key IN ({placeholders}) AND created >= ?",
+                                     chunk + [now - self.ttl])
+            for key, result in rows:
+                found[key] = json.loads(result)
+
+        if found:
+            self.conn.executemany("UPDATE addresses SET accessed = ? WHERE key = ?",
+                                  [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def put_many(self, items):
+        """Store an iterable of (key, result) pairs and apply TTL/size eviction."""
+        now = time.time()
+        rows = [(key, json.dumps({field: result.get(field) for field in CACHED_FIELDS}), now, now)
+                for key, result in items]
+        if not rows:
+            return
+
+        self.conn.executemany("INSERT OR REPLACE INTO addresses (key, result, created, accessed) "
+                              "VALUES (?, ?, ?, ?)", rows)
+        self.evict(now)
+        self.conn.commit()
+
+    def evict(self, now=None):
+        now = now or time.time()
+        self.conn.execute("DELETE FROM addresses WHERE created < ?", (now - self.ttl,))
+
+        count = self.conn.execute("SELECT COUNT(*) FROM addresses").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM addresses WHERE key IN ("
+                              "SELECT key FROM addresses ORDER BY accessed LIMIT ?)",
+                              (count - self.max_entries,))
+
+    def close(self):
+        self.conn.close()
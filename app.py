@@ -1,10 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory
-from csv_transformer import modify_csv
+from flask import Flask, Response, render_template, request, redirect, url_for, send_from_directory, jsonify, abort, \
+    stream_with_context
+from csv_transformer import export_name, gzip_chunks, stream_csv
+from export_cache import ExportCache, export_key, save_upload
+from formats import available_formats
+from jobs import JobQueue, DONE
+from metrics import StageHistograms, StageMetrics
+from werkzeug.utils import secure_filename
+import logging
 import os
+import threading
+import uuid
+
+logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
 app.config["UPLOADS_DIR"] = "uploads"
 app.config["EXPORTS_DIR"] = "exports"
+app.config["JOBS_DIR"] = "jobs"
+# number of uploads transformed at the same time
+app.config["MAX_CONCURRENT_JOBS"] = 2
+# files streamed through /stream at the same time; more are turned away
+app.config["MAX_CONCURRENT_STREAMS"] = 2
+# processes each job uses for the name and address checks
+app.config["TRANSFORM_WORKERS"] = 1
+# exports kept for uploads of the same file; least recently used go first
+app.config["EXPORT_CACHE_PATH"] = os.path.join("cache", "exports.sqlite")
+app.config["EXPORT_CACHE_MAX_ENTRIES"] = 1000
+app.config["EXPORT_CACHE_MAX_BYTES"] = 10 * 2 ** 30
+
+os.makedirs(app.config["UPLOADS_DIR"], exist_ok=True)
+# stage latencies of the jobs this process has run, served at /metrics
+stage_histograms = StageHistograms()
+# an export's size is recorded when its job ends, and only then can it be evicted
+job_queue = JobQueue(app.config["JOBS_DIR"], max_workers=app.config["MAX_CONCURRENT_JOBS"],
+                     on_done=stage_histograms.observe, on_finished=lambda job_id: export_cache.record_size(job_id))
+export_cache = ExportCache(app.config["EXPORT_CACHE_PATH"], max_entries=app.config["EXPORT_CACHE_MAX_ENTRIES"],
+                           max_bytes=app.config["EXPORT_CACHE_MAX_BYTES"], finished=job_queue.finished)
+# one upload at a time looks up and submits, so the same file uploaded
+# twice at once is only transformed once
+submit_lock = threading.Lock()
+# the USPS limits in config.py are shared between every job and stream that
+# can run at once, so together they keep to them
+usps_processes = app.config["MAX_CONCURRENT_JOBS"] + app.config["MAX_CONCURRENT_STREAMS"]
+stream_slots = threading.BoundedSemaphore(app.config["MAX_CONCURRENT_STREAMS"])
 
 @app.route("/", methods=["GET", "POST"])
 def upload_file():
@@ -17,25 +55,109 @@ def upload_file():
         if file.filename == "":
             return "File name is empty"
 
-        file_path = os.path.join(app.config["UPLOADS_DIR"], file.filename)
-        file.save(file_path)
+        output_format = request.form.get("format", "csv")
+        if output_format not in available_formats():
+            return "Unknown export format"
+
+        # uploads are stored by content, so the client's file name never
+        # picks the path and a file uploaded again is recognised
+        file_path, digest = save_upload(file.stream, app.config["UPLOADS_DIR"])
+        key = export_key(digest, output_format)
+
+        with submit_lock:
+            # reuse the export of an earlier upload of the same file
+            job_id = export_cache.get(key)
+            job_id = job_queue.reuse(job_id, file.filename) if job_id is not None else None
+
+            if job_id is None:
+                # Modify the CSV file in the background and check on it from the confirmation page;
+                # every job writes to its own directory
+                export_dir = os.path.join(app.config["EXPORTS_DIR"], uuid.uuid4().hex)
+                job_id = job_queue.submit(file_path, filename=file.filename, workers=app.config["TRANSFORM_WORKERS"],
+                                          output_format=output_format, output_dir=export_dir,
+                                          usps_processes=usps_processes)
+                export_cache.put(key, job_id, file_path, export_dir)
+
+        return redirect(url_for("confirmation", job_id=job_id))
+
+    return render_template("upload.html", formats=available_formats())
+
+@app.route("/stream", methods=["POST"])
+def stream():
+    # transform the request body as it arrives and send the export back as it
+    # is produced: POST the CSV (plain or gzip) as the raw body, with
+    # ?filename= naming the upload and ?compress=gzip for a gzip response.
+    # rows are sorted within each chunk of CHUNK_ROWS rows, not across the file
+    if not stream_slots.acquire(blocking=False):
+        return "Too many files are being streamed, try again shortly", 503, {"Retry-After": "30"}
+    filename = secure_filename(request.args.get("filename", "")) or "upload.csv"
+    metrics = StageMetrics()
+    chunks = stream_csv(request.stream, metrics=metrics, name=filename,
+                        workers=app.config["TRANSFORM_WORKERS"], usps_processes=usps_processes)
+
+    # the first chunk is ready once it has been read and transformed, so a
+    # file that can't be read is reported before the response starts
+    try:
+        first = next(chunks)
+    except (ValueError, KeyError) as e:
+        stream_slots.release()
+        return f"Could not read the file: {e}", 400
+    except BaseException:
+        stream_slots.release()
+        raise
+
+    def generate():
+        yield first
+        yield from chunks
+        stage_histograms.observe(metrics.summary())
+
+    body, name, mimetype = stream_with_context(generate()), export_name(filename), "text/csv"
+    if request.args.get("compress") == "gzip":
+        body, name, mimetype = gzip_chunks(body), name + ".gz", "application/gzip"
+    response = Response(body, mimetype=mimetype, headers={"Content-Disposition": f'attachment; filename="{name}"'})
+    # the slot is given back once the response is sent or the client goes away
+    response.call_on_close(stream_slots.release)
+    return response
 
-        # Modify the CSV file and get a new file path
-        modified_file_path = modify_csv(file_path)
-        modified_file_name = os.path.basename(modified_file_path)
+@app.route("/status/<job_id>")
+def status(job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        abort(404)
+    job = {key: value for key, value in job.items() if key != "export"}
+    return jsonify(job)
 
-        return redirect(url_for("confirmation", filename=modified_file_name))
+@app.route("/metrics")
+def metrics():
+    return stage_histograms.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
-    return render_template("upload.html")
+@app.route("/confirmation/<job_id>")
+def confirmation(job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        abort(404)
+    return render_template("confirmation.html", job=job, done=job["state"] == DONE)
 
-@app.route("/confirmation/<filename>")
-def confirmation(filename):
-    return render_template("confirmation.html", filename=filename)
+@app.route("/download/<job_id>")
+def download(job_id):
+    job = job_queue.status(job_id)
+    if job is None or job["state"] != DONE:
+        abort(404)
+    exports_dir, filename = os.path.split(job["export"])
+    # exports are stored by content; name the download after the upload
+    download_name = os.path.splitext(export_name(job["filename"]))[0] + os.path.splitext(filename)[1]
+    if not os.path.exists(job["export"]):
+        # evicted from the export cache
+        abort(404)
+    if request.args.get("compress") == "gzip":
+        # compressed on the fly rather than stored twice
+        def read_export():
+            with open(job["export"], "rb") as f:
+                yield from iter(lambda: f.read(64 * 1024), b"")
 
-@app.route("/download/<filename>")
-def download(filename):
-    exports_dir = app.config["EXPORTS_DIR"]
-    return send_from_directory(exports_dir, filename, as_attachment=True)
+        return Response(gzip_chunks(read_export()), mimetype="application/gzip",
+                        headers={"Content-Disposition": f'attachment; filename="{secure_filename(download_name)}.gz"'})
+    return send_from_directory(exports_dir, filename, as_attachment=True, download_name=download_name)
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,102 @@
+"""Compare the columnar address checks with the row-by-row loop they replaced.
+
+    python benchmarks/address_stage.py [rows]
+
+Both versions run on the same synthetic frame; the script checks they set the
+same flags and prints how long each took.
+"""
+#%%
+import random
+import sys
+import time
+
+import pandas as pd
+
+import common  # puts the repo on sys.path
+from csv_transformer import US_STATES, check_addresses
+
+#%%
+def make_frame(rows, seed=0):
+    rng = random.Random(seed)
+    address1 = ['', '12 Main St.', '400 Oak Ave', '9 Elm Rd', '1600 Pennsylvania Ave NW']
+    address2 = ['', '', 'Apt 4', '# 12', '#3B', 'Suite 200.']
+    cities = ['', 'Springfield', 'Reno', 'Arlington']
+    states = ['', 'CA', 'NY', 'va', 'ZZ', 'PR', 'TX']
+    zips = ['', '22201', '89501-1234']
+
+    data = {'ADDRESS1': [], 'ADDRESS2': [], 'CITY': [], 'STATE_PROVINCE': [], 'ZIP_POSTALCODE': [], 'COUNTRY': []}
+    for _ in range(rows):
+        blank = rng.random() < 0.05
+        data['ADDRESS1'].append('' if blank else rng.choice(address1))
+        data['ADDRESS2'].append('' if blank else rng.choice(address2))
+        data['CITY'].append('' if blank else rng.choice(cities))
+        data['STATE_PROVINCE'].append('' if blank else rng.choice(states))
+        data['ZIP_POSTALCODE'].append('' if blank else rng.choice(zips))
+        data['COUNTRY'].append('US')
+    return pd.DataFrame(data)
+
+#%%
+def check_addresses_loop(df):
+    # the iterrows version, with its misplaced `continue` fixed so the
+    # incomplete-address check and FULL_ADDRESS construction actually run
+    df = df[df['COUNTRY'] == 'US']
+    df = df[~df['STATE_PROVINCE'].isin(['VI', 'PR', 'GU', 'AS'])].copy()
+    df['STATE_INVALID'] = 'N'
+    df['ADDRESS_BLANK'] = 'N'
+    df['ADDRESS_INCOMPLETE'] = 'N'
+    df['FULL_ADDRESS'] = ''
+    df["ADDRESS2"] = df["ADDRESS2"].str.replace("# ", "Unit ")
+    df["ADDRESS2"] = df["ADDRESS2"].str.replace("#", "Unit ")
+
+    for i, row in df.iterrows():
+        address_line1 = row['ADDRESS1'].strip().rstrip('.')
+        address_line2 = row['ADDRESS2'].strip().rstrip('.')
+        city = row['CITY'].strip()
+        state = row['STATE_PROVINCE'].strip().upper()
+        zipcode = row['ZIP_POSTALCODE'].strip()
+
+        if address_line1 == '' and address_line2 == '' and city == '' and state == '' and zipcode == '':
+            df.at[i, 'ADDRESS_BLANK'] = 'Y'
+            df.at[i, 'STATE_INVALID'] = 'Y'
+            continue
+
+        if state == '' or state not in US_STATES:
+            df.at[i, 'STATE_INVALID'] = 'Y'
+            df.at[i, 'ADDRESS_INCOMPLETE'] = 'Y'
+            continue
+
+        if address_line1 == '' or zipcode == '' or state == '':
+            df.at[i, 'ADDRESS_INCOMPLETE'] = 'Y'
+            continue
+
+        full_address_parts = [part for part in [address_line1, address_line2, city, state, zipcode] if part != '']
+        df.at[i, 'ADDRESS1'] = address_line1
+        df.at[i, 'ADDRESS2'] = address_line2
+        df.at[i, 'FULL_ADDRESS'] = ', '.join(full_address_parts)
+
+    df.loc[df['ADDRESS_INCOMPLETE'] == 'Y', 'ADDRESS_BLANK'] = 'N'
+    df = df[df['ADDRESS_BLANK'] != 'Y']
+    df = df.drop("ADDRESS_BLANK", axis=1)
+    # check_addresses keeps its flags as booleans
+    for column in ['STATE_INVALID', 'ADDRESS_INCOMPLETE']:
+        df[column] = df[column] == 'Y'
+    return df
+
+#%%
+def timed(function, df):
+    start = time.perf_counter()
+    result = function(df)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    df = make_frame(rows)
+
+    expected, loop_seconds = timed(check_addresses_loop, df)
+    result, columnar_seconds = timed(check_addresses, df)
+
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
+
+    print(f"{rows} rows")
+    print(f"iterrows loop: {loop_seconds:8.3f}s")
+    print(f"columnar:      {columnar_seconds:8.3f}s  ({loop_seconds / columnar_seconds:.0f}x faster)")
@@ -0,0 +1,118 @@
+"""Time each stage of modify_csv and track peak memory.
+
+    python benchmarks/bench_modify_csv.py [--rows 10000 100000] [--latency 0.05]
+                                          [--chunksize N] [--workers N] [--json results.json]
+
+Exports are generated with generate_exports.py if they don't exist yet, and
+address validation goes to a local USPS stub, so runs are repeatable and never
+touch the real API. Each size is measured twice: stage by stage in this
+process (wall time and peak traced allocations per stage), then end to end
+through modify_csv in a fresh process (wall time and peak RSS).
+"""
+#%%
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import common
+import csv_transformer
+from generate_exports import generate
+from usps import USPSClient
+from usps_stub import USPSStub
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+#%%
+def measure(results, stage, function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(value) if hasattr(value, "__len__") else None
+    results.append({"stage": stage, "seconds": seconds, "peak_mb": peak / 2 ** 20, "rows": rows})
+    return value
+
+def bench_stages(path, stub_url, tmp_dir):
+    results = []
+    client = USPSClient(common.config.USPS_API_KEY, api_url=stub_url)
+    try:
+        df = measure(results, "read", csv_transformer.read_records, path)
+        df = measure(results, "clean", csv_transformer.clean_records, df)
+        df = measure(results, "names", csv_transformer.transform_records, df)
+        df = measure(results, "addresses", csv_transformer.check_addresses, df)
+        validated = measure(results, "validation", csv_transformer.validate_addresses, df, client)
+        df = measure(results, "finalize", csv_transformer.finalize_records, df, validated)
+        df = measure(results, "sort", csv_transformer.sort_records, df)
+        measure(results, "write", csv_transformer.write_records, df, os.path.join(tmp_dir, "stages.csv"))
+    finally:
+        client.close()
+    return results
+
+def run_modify_csv(path, stub_url, chunksize, workers):
+    # runs in a fresh worker process so ru_maxrss belongs to this run alone
+    import resource
+
+    client = USPSClient(common.config.USPS_API_KEY, api_url=stub_url)
+    start = time.perf_counter()
+    csv_transformer.modify_csv(path, usps_client=client, address_cache=False,
+                               chunksize=chunksize, workers=workers)
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    peak_mb = peak_kb / 2 ** 20 if os.uname().sysname == "Darwin" else peak_kb / 2 ** 10
+    return {"seconds": seconds, "peak_rss_mb": peak_mb}
+
+def bench_end_to_end(path, stub_url, tmp_dir, chunksize, workers):
+    # modify_csv writes to ../exports next to the upload, so stage a copy
+    uploads = os.path.join(tmp_dir, "uploads")
+    os.makedirs(uploads, exist_ok=True)
+    upload = os.path.join(uploads, os.path.basename(path))
+    shutil.copy(path, upload)
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(run_modify_csv, upload, stub_url, chunksize, workers).result()
+
+#%%
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stub response")
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    report = []
+    with USPSStub(latency=args.latency) as stub:
+        for rows in args.rows:
+            path = os.path.join(DATA_DIR, f"qtool_{rows}.csv")
+            if not os.path.exists(path):
+                print(f"generating {path}")
+                generate(path, rows)
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                stages = bench_stages(path, stub.url, tmp_dir)
+                end_to_end = bench_end_to_end(path, stub.url, tmp_dir, args.chunksize, args.workers)
+            report.append({"rows": rows, "stages": stages, "modify_csv": end_to_end})
+
+            print(f"\n{rows} rows")
+            print(f"  {'stage':<12}{'seconds':>10}{'peak MB':>10}{'rows out':>10}")
+            for stage in stages:
+                print(f"  {stage['stage']:<12}{stage['seconds']:>10.3f}{stage['peak_mb']:>10.1f}"
+                      f"{stage['rows'] if stage['rows'] is not None else '':>10}")
+            print(f"  modify_csv  {end_to_end['seconds']:>10.3f}s, peak RSS {end_to_end['peak_rss_mb']:.0f} MB, "
+                  f"{rows / end_to_end['seconds']:,.0f} rows/s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# shared setup for the benchmark scripts: make the repo importable and fall
+# back to a placeholder config when there is no config.py, since benchmarks
+# only ever talk to the local USPS stub
+import os
+import sys
+import types
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType("config")
+    config.USPS_API_KEY = "BENCHMARK"
+    sys.modules["config"] = config
@@ -0,0 +1,129 @@
+"""Time the duplicate check and the email heuristic on a large export.
+
+    python benchmarks/dedupe.py [--rows 1000000] [--chunksize 10000] [--pairwise 5000]
+
+The synthetic upload is cleaned, transformed and address-checked as
+modify_csv would (without validation; the USPS columns are left blank), and
+one record in 100 is listed again under a new ROI_FAMILY_ID with its last
+name and street spelled a little differently, which must all be flagged.
+check_emails is timed against the row-by-row version it replaced, and the
+DuplicateIndex against comparing every record with every earlier one. The
+pairwise check only runs on the first --pairwise records, its time for the
+whole file is extrapolated. The script checks each pair gives the same flags.
+"""
+#%%
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import common  # puts the repo on sys.path
+import csv_transformer
+from generate_exports import generate
+from matching import DuplicateIndex, match_keys
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+#%%
+def add_duplicates(df, every=100):
+    # "Smith" as "Smithe" and "12 Main St" as "12 main st.", same Soundex and
+    # address; only records with a match key can have duplicates. Each copy
+    # comes about 1000 rows after its record, in another chunk now and then
+    copies = df[match_keys(df)[1]].iloc[::every].copy()
+    copies.index = copies.index + 1000.5
+    copies["ROI_FAMILY_ID"] = "DUP" + copies["ROI_FAMILY_ID"].astype(str)
+    copies["LASTNAME"] = copies["LASTNAME"] + "e"
+    copies["ADDRESS1"] = copies["ADDRESS1"].str.lower() + "."
+    return pd.concat([df, copies]).sort_index()
+
+
+def check_emails_rowwise(df):
+    # the version that tested every row
+    df = df.copy()
+    email = df["EMAIL"].str.lower()
+    last = df["LASTNAME"].str.lower()
+    spouse_last = df["SPOUSELASTNAME"].str.lower()
+
+    in_email = pd.Series([name in address for name, address in zip(last, email)], index=df.index)
+    spouse_in_email = pd.Series([name in address for name, address in zip(spouse_last, email)], index=df.index)
+
+    df["CHECK_EMAIL"] = (email.str.strip() != "") & df["REVIEW"] & \
+        ((in_email & (last.str.len() > 1)) | (spouse_in_email & (spouse_last.str.len() > 1)))
+    return df
+
+
+def flag_pairwise(df):
+    # every record against every earlier one until one of them shares its key
+    keys, keyed = match_keys(df)
+    keys = [key if has_key else None for key, has_key in zip(keys.itertuples(index=False, name=None), keyed)]
+    families = df["ROI_FAMILY_ID"].tolist()
+    flags = []
+    for i, key in enumerate(keys):
+        flag = False
+        if key is not None:
+            for j in range(i):
+                if keys[j] == key:
+                    flag = families[j] != families[i]
+                    break
+        flags.append(flag)
+    return np.array(flags)
+
+
+def flag_indexed(df, chunksize=None):
+    index = DuplicateIndex()
+    if not chunksize:
+        return index.flag(df).to_numpy()
+    return np.concatenate([index.flag(df.iloc[start:start + chunksize]).to_numpy()
+                           for start in range(0, len(df), chunksize)])
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+#%%
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chunksize", type=int, default=10_000, help="rows per chunk for the chunked run")
+    parser.add_argument("--pairwise", type=int, default=5_000, help="records given to the pairwise check")
+    args = parser.parse_args()
+
+    path = os.path.join(DATA_DIR, f"qtool_{args.rows}.csv")
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"generating {path}")
+        generate(path, args.rows)
+
+    df = csv_transformer.clean_records(csv_transformer.read_records(path))
+    names = csv_transformer.transform_names(df)
+    expected, rowwise_seconds = timed(check_emails_rowwise, names)
+    result, masked_seconds = timed(csv_transformer.check_emails, names)
+    pd.testing.assert_series_equal(result["CHECK_EMAIL"], expected["CHECK_EMAIL"])
+
+    df = csv_transformer.check_addresses(csv_transformer.transform_records(df))
+    df = add_duplicates(df.assign(V_STREET="", V_ZIP5=""))
+    added = (df["ROI_FAMILY_ID"].astype(str).str.startswith("DUP")).to_numpy()
+    flags, indexed_seconds = timed(flag_indexed, df)
+    chunked, chunked_seconds = timed(flag_indexed, df, args.chunksize)
+    assert (chunked == flags).all()
+    assert (flags | ~added).all()
+    sample = df.iloc[:args.pairwise]
+    pairwise, pairwise_seconds = timed(flag_pairwise, sample)
+    assert (pairwise == flags[:len(sample)]).all()
+    pairwise_estimate = pairwise_seconds * (len(df) / len(sample)) ** 2
+
+    print(f"{args.rows} rows, {len(df)} after the address checks with {int(added.sum())} duplicates added")
+    print(f"check_emails   row by row: {rowwise_seconds:8.3f}s   review rows only: {masked_seconds:8.3f}s"
+          f"  ({rowwise_seconds / masked_seconds:.1f}x faster), {int(result['CHECK_EMAIL'].sum())} marked")
+    print(f"duplicates     index: {indexed_seconds:8.3f}s   in {args.chunksize}-row chunks: {chunked_seconds:8.3f}s"
+          f"   {int(flags.sum())} flagged")
+    print(f"               pairwise: {pairwise_seconds:8.3f}s for {len(sample)} records ({int(pairwise.sum())} flagged),"
+          f" about {pairwise_estimate:,.0f}s for all of them")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Compare the memory held by the typed frames with the all-text frames they replaced.
+
+    python benchmarks/frame_memory.py [--rows 100000]
+
+The upload is read the old way (every column a Python str) and the way
+read_records reads it now, then taken through to the export frame both as
+typed columns and as the text frame the stages used to hand to to_csv.
+Sizes count the strings themselves (memory_usage(deep=True)).
+"""
+#%%
+import argparse
+import os
+
+import common
+import csv_transformer
+import pandas as pd
+from generate_exports import generate
+from schema import LENGTH_COLUMNS, frame_memory_mb, to_text
+from usps import USPSClient
+from usps_stub import USPSStub
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+#%%
+def export_frame(df, stub_url):
+    client = USPSClient(common.config.USPS_API_KEY, api_url=stub_url)
+    try:
+        return csv_transformer.process_records(df, client)
+    finally:
+        client.close()
+
+def report(name, legacy, typed):
+    legacy_mb, typed_mb = frame_memory_mb(legacy), frame_memory_mb(typed)
+    print(f"  {name:<8}{legacy_mb:>12.1f}{typed_mb:>12.1f}{legacy_mb / typed_mb:>9.1f}x")
+
+#%%
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    path = os.path.join(DATA_DIR, f"qtool_{args.rows}.csv")
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"generating {path}")
+        generate(path, args.rows)
+
+    legacy = pd.read_csv(path, encoding='ISO-8859-1', dtype=str, low_memory=False)
+    typed = csv_transformer.read_records(path)
+    with USPSStub() as stub:
+        exported = export_frame(typed, stub.url)
+
+    print(f"{args.rows} rows")
+    print(f"  {'frame':<8}{'text MB':>12}{'typed MB':>12}{'smaller':>10}")
+    report("read", legacy, typed)
+    # the old export frame: text throughout apart from the int64 name lengths
+    text = to_text(exported)
+    report("export", text.astype({column: object for column in text.columns if column not in LENGTH_COLUMNS})
+           .astype({column: "int64" for column in LENGTH_COLUMNS}), exported)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Generate synthetic donor exports in the qtool column layout.
+
+    python benchmarks/generate_exports.py [--rows 10000 100000 1000000] [--out benchmarks/data]
+
+Writes one qtool_<rows>.csv per size. The mix of records is meant to exercise
+every branch of modify_csv: "&"/"and" couples, initials, spouse-only names,
+hidden prefixes and suffixes, family/foundation records, non-US, territory,
+blank and incomplete addresses.
+"""
+#%%
+import argparse
+import csv
+import os
+import random
+
+import common
+
+STRUCTURE_FILE = os.path.join(common.REPO_DIR, "validate", "qtool_structure.csv")
+
+FIRST_NAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David",
+               "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas",
+               "Sarah", "Carlos", "Maria", "Wei", "Mei", "Aarav", "Priya", "Olu", "Ngozi", "José", "Zoë"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+              "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore",
+              "Nguyen", "Chen", "Patel", "O'Brien", "Van Der Berg", "Okafor", "Müller"]
+MIDDLE_NAMES = ["", "", "", "A", "B.", "J", "Lee", "Marie", "Ann", "R."]
+INITIALS = ["T.J.", "J.R.", "A.B.C.", "J.", "M", "K."]
+PREFIXED = ["Mr. John", "Dr Sarah", "Rev. Thomas", "Mrs Linda"]
+SUFFIXED = ["John Jr", "Robert III", "William Sr.", "James II"]
+SUFFIXES = ["", "", "", "", "Jr.", "Sr", "III"]
+STREETS = ["Main St", "Oak Ave", "Maple Dr", "Cedar Ln", "Elm St", "Washington Blvd", "Lake Shore Dr"]
+UNITS = ["", "", "", "Apt 4", "# 12", "#3B", "Suite 200", "Unit 7."]
+CITIES = [("Arlington", "VA", "22201"), ("Springfield", "IL", "62701"), ("Reno", "NV", "89501"),
+          ("Austin", "TX", "78701"), ("Portland", "OR", "97201"), ("Boston", "MA", "02108"),
+          ("Denver", "CO", "80202"), ("Atlanta", "GA", "30303")]
+TERRITORIES = [("San Juan", "PR", "00901"), ("Hagatna", "GU", "96910"), ("Charlotte Amalie", "VI", "00802")]
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "aol.com", "example.org"]
+
+
+def read_columns():
+    with open(STRUCTURE_FILE, encoding="utf-8-sig") as f:
+        return next(csv.reader(f))
+
+#%%
+def make_name(rng, record):
+    kind = rng.random()
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    spouse_first, spouse_last = "", ""
+
+    if kind < 0.08:
+        # couple in FIRSTNAME
+        spouse = rng.choice(FIRST_NAMES)
+        first = f"{first} {rng.choice(['&', 'and', 'And'])} {spouse}"
+    elif kind < 0.13:
+        first = rng.choice(INITIALS)
+    elif kind < 0.17:
+        # primary name is only initials but the spouse name is usable
+        first = rng.choice(["J", "M.", ""])
+        spouse_first, spouse_last = rng.choice(FIRST_NAMES), last
+    elif kind < 0.19:
+        first = rng.choice(PREFIXED)
+    elif kind < 0.21:
+        first = rng.choice(SUFFIXED)
+    elif kind < 0.23:
+        last = f"{last} {rng.choice(['Family', 'Foundation', 'Family Trust'])}"
+    elif kind < 0.24:
+        last = rng.choice(["X", "", "Smith2"])
+
+    if not spouse_first and rng.random() < 0.3:
+        spouse_first, spouse_last = rng.choice(FIRST_NAMES), rng.choice([last, rng.choice(LAST_NAMES)])
+
+    record.update(FIRSTNAME=first, MIDDLENAME_INITIAL=rng.choice(MIDDLE_NAMES), LASTNAME=last,
+                  SUFFIX=rng.choice(SUFFIXES), SPOUSEFIRSTNAME=spouse_first, SPOUSELASTNAME=spouse_last,
+                  SPOUSEMIDDLENAME_INITIAL=rng.choice(MIDDLE_NAMES) if spouse_first else "",
+                  PREFIX=rng.choice(["", "Mr.", "Ms.", "Dr."]),
+                  SPOUSEPREFIX=rng.choice(["", "Mr.", "Mrs."]) if spouse_first else "")
+
+    if rng.random() < 0.6:
+        user = f"{first.split(' ')[0].strip('.').lower()}.{last.split(' ')[0].lower()}"
+        record["EMAIL"] = f"{user or 'donor'}{rng.randint(1, 99)}@{rng.choice(EMAIL_DOMAINS)}"
+
+def make_address(rng, record):
+    kind = rng.random()
+    city, state, zipcode = rng.choice(CITIES)
+    record.update(COUNTRY="US", ADDRESS1=f"{rng.randint(1, 9999)} {rng.choice(STREETS)}{rng.choice(['', '.'])}",
+                  ADDRESS2=rng.choice(UNITS), CITY=city, STATE_PROVINCE=state,
+                  ZIP_POSTALCODE=zipcode if rng.random() < 0.7 else f"{zipcode}-{rng.randint(1000, 9999)}")
+
+    if kind < 0.03:
+        # non-US
+        record.update(COUNTRY=rng.choice(["CA", "GB", "MX"]), STATE_PROVINCE=rng.choice(["ON", "", "BC"]))
+    elif kind < 0.04:
+        city, state, zipcode = rng.choice(TERRITORIES)
+        record.update(CITY=city, STATE_PROVINCE=state, ZIP_POSTALCODE=zipcode)
+    elif kind < 0.07:
+        record.update(ADDRESS1="", ADDRESS2="", CITY="", STATE_PROVINCE="", ZIP_POSTALCODE="")
+    elif kind < 0.09:
+        # incomplete or invalid state
+        record.update(rng.choice([{"ZIP_POSTALCODE": ""}, {"ADDRESS1": ""}, {"STATE_PROVINCE": "XX"},
+                                  {"STATE_PROVINCE": ""}]))
+
+def make_gifts(rng, record):
+    count = rng.randint(1, 40)
+    amounts = sorted(round(rng.choice([10, 25, 50, 100, 250, 1000]) * rng.uniform(0.5, 2), 2) for _ in range(3))
+    record.update(TOTALGIFTCOUNT=count, LARGESTGIFT=amounts[-1], LASTGIFTAMOUNT=amounts[1],
+                  FIRSTGIFTAMOUNT=amounts[0], TOTALGIFTAMOUNT=round(sum(amounts) * count / 3, 2),
+                  FIRSTGIFTDATE=f"{rng.randint(1995, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                  LARGESTGIFTDATE=f"{rng.randint(2010, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                  LASTGIFTDATE=f"{rng.randint(2020, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+    if rng.random() < 0.5:
+        record["AGE"] = rng.randint(25, 95)
+    if rng.random() < 0.4:
+        record["PHONE"] = f"{rng.randint(200, 999)}-{rng.randint(200, 999)}-{rng.randint(0, 9999):04d}"
+
+def generate(path, rows, seed=0):
+    rng = random.Random(seed)
+    columns = read_columns()
+    with open(path, "w", newline="", encoding="ISO-8859-1", errors="replace") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for i in range(rows):
+            record = dict.fromkeys(columns, "")
+            record["ROI_ID"] = 100_000_000 + i
+            record["ROI_FAMILY_ID"] = 200_000_000 + i // rng.choice([1, 1, 1, 2])
+            make_name(rng, record)
+            make_address(rng, record)
+            make_gifts(rng, record)
+            writer.writerow(record)
+    return path
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for rows in args.rows:
+        path = generate(os.path.join(args.out, f"qtool_{rows}.csv"), rows, args.seed)
+        print(f"wrote {rows} rows to {path}")
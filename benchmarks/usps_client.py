@@ -0,0 +1,85 @@
+"""Compare the thread pool and asyncio USPS clients against a struggling endpoint.
+
+    python benchmarks/usps_client.py [--addresses 2000] [--latency 0.05]
+
+Both clients validate the same addresses against the local stub under a few
+scenarios: a healthy endpoint, one failing a share of requests, one with a
+slow tail past the request timeout, and an outage that ends part way through
+the run. For each the script prints the wall time, how many addresses were
+left NOT_VALIDATED, request counts and latency percentiles.
+"""
+#%%
+import argparse
+import logging
+import threading
+import time
+
+import common
+from usps import ASYNC_AVAILABLE, NOT_VALIDATED, AsyncUSPSClient, USPSClient
+from usps_stub import USPSStub
+
+# name, stub settings, seconds the endpoint is down at the start of the run
+SCENARIOS = [
+    ("healthy", {}, 0),
+    ("10% errors", {"error_rate": 0.1}, 0),
+    ("slow tail", {"slow_rate": 0.02, "slow_latency": 3.0}, 0),
+    ("outage", {}, 3),
+]
+
+#%%
+def make_addresses(count):
+    return [(f"Donor {i}", f"{i} Main St", "", "Springfield", f"{22000 + i % 900:05d}") for i in range(count)]
+
+
+def run(client, stub, addresses, outage):
+    # the stub comes back up after `outage` seconds
+    stub.down = outage > 0
+    timer = threading.Timer(outage, setattr, (stub, "down", False))
+    timer.start()
+    start = time.perf_counter()
+    try:
+        results = client.validate(addresses)
+    finally:
+        timer.cancel()
+        client.close()
+    seconds = time.perf_counter() - start
+    not_validated = sum(result["VALIDATION_ERROR"] == NOT_VALIDATED for result in results)
+    return seconds, not_validated, client.stats()
+
+
+def clients(url, workers, timeout):
+    yield "threads", USPSClient(common.config.USPS_API_KEY, api_url=url, max_workers=workers, timeout=timeout,
+                                backoff=0.1)
+    if ASYNC_AVAILABLE:
+        yield "asyncio", AsyncUSPSClient(common.config.USPS_API_KEY, api_url=url, max_concurrency=workers,
+                                         timeout=timeout, backoff=0.1, target_latency=timeout / 2,
+                                         reset_timeout=1.0)
+
+#%%
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--addresses", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every stub response")
+    parser.add_argument("--workers", type=int, default=8, help="threads, or the most requests in flight")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds before a request is given up")
+    args = parser.parse_args()
+
+    # failed requests are expected here; only the totals matter
+    logging.getLogger("csv_transformer").setLevel(logging.ERROR)
+    addresses = make_addresses(args.addresses)
+    if not ASYNC_AVAILABLE:
+        print("aiohttp is not installed, only the thread pool client is measured")
+    print(f"{args.addresses} addresses, {args.latency}s latency, timeout {args.timeout}s")
+    print(f"  {'scenario':<12}{'client':<9}{'seconds':>9}{'not valid.':>11}{'requests':>10}{'failed':>8}"
+          f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}")
+    for name, settings, outage in SCENARIOS:
+        for client_name, client in clients("", args.workers, args.timeout):
+            with USPSStub(latency=args.latency, jitter=args.latency, **settings) as stub:
+                client.api_url = stub.url
+                seconds, not_validated, stats = run(client, stub, addresses, outage)
+            print(f"  {name:<12}{client_name:<9}{seconds:>9.2f}{not_validated:>11}{stats['requests']:>10}"
+                  f"{stats['failures']:>8}{stats['p50_ms']:>9}{stats['p90_ms']:>9}{stats['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
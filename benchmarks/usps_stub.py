@@ -0,0 +1,122 @@
+"""A local stand-in for the USPS Verify endpoint.
+
+Every address with a street line and a ZIP code validates; anything else gets
+an <Error>, as USPS does for addresses it can't find. `latency` adds a fixed
+delay per request to mimic the real round trip, plus up to `jitter` seconds
+more at random. For testing how clients cope with a struggling endpoint,
+`error_rate` answers that fraction of requests with a 503, `slow_rate` holds
+that fraction for `slow_latency` seconds, and setting `down` answers every
+request with a 503 until it is cleared.
+"""
+#%%
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+#%%
+def verify_response(request_xml):
+    try:
+        request = ET.fromstring(request_xml)
+    except ET.ParseError:
+        return "<Error><Number>80040B19</Number><Description>XML Syntax Error</Description></Error>"
+
+    parts = ["<AddressValidateResponse>"]
+    for address in request.findall("Address"):
+        address_id = escape(address.get("ID", ""), {'"': "&quot;"})
+        street = (address.findtext("Address2") or "").upper()
+        city = (address.findtext("City") or "").upper()
+        zip5 = (address.findtext("Zip5") or "")[:5]
+        if not street or not zip5:
+            parts.append(f'<Address ID="{address_id}"><Error><Number>-2147219401</Number>'
+                         f'<Description>Address Not Found.</Description></Error></Address>')
+            continue
+        parts.append(f'<Address ID="{address_id}"><Address2>{escape(street)}</Address2>'
+                     f'<City>{escape(city)}</City><State>VA</State><Zip5>{zip5}</Zip5>'
+                     f'<Zip4>0001</Zip4></Address>')
+    parts.append("</AddressValidateResponse>")
+    return "".join(parts)
+
+class USPSStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            draw, slow, jitter = server.random.random(), server.random.random(), server.random.random()
+        delay = server.latency + jitter * server.jitter
+        if slow < server.slow_rate:
+            delay = server.slow_latency
+        if delay:
+            time.sleep(delay)
+
+        if server.down or draw < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        query = parse_qs(urlparse(self.path).query)
+        body = verify_response(query.get("XML", [""])[0]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class USPSStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before the answer is written
+        pass
+
+#%%
+class USPSStub:
+    """Run the stub on a free local port for the lifetime of a `with` block."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, slow_rate=0.0, slow_latency=5.0, seed=0):
+        self.server = USPSStubServer(("127.0.0.1", 0), USPSStubHandler)
+        self.server.latency = latency
+        self.server.jitter = jitter
+        self.server.error_rate = error_rate
+        self.server.slow_rate = slow_rate
+        self.server.slow_latency = slow_latency
+        self.server.down = False
+        self.server.random = random.Random(seed)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.errors = 0
+        self.url = f"http://127.0.0.1:{self.server.server_port}/ShippingAPI.dll"
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def errors(self):
+        return self.server.errors
+
+    @property
+    def down(self):
+        return self.server.down
+
+    @down.setter
+    def down(self, down):
+        self.server.down = down
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,187 @@
+#%%
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from record_store import TRANSFORM_VERSION
+
+# a checkpoint is locked by the run using it; flock locks go away with the
+# process that held them, so a run that dies leaves its checkpoint free to
+# resume. Without fcntl (Windows) there is no way to tell, and runs aren't
+# checkpointed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# whether runs can be checkpointed here
+CHECKPOINTS_AVAILABLE = fcntl is not None
+
+LOCK_FILE = "lock"
+
+#%%
+def upload_key(path, block_size=1 << 20):
+    # sha256 of the upload's bytes plus the transform version: the same file
+    # uploaded again under any name gets the same checkpoint
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return f"{digest.hexdigest()}-v{TRANSFORM_VERSION}"
+
+
+def lock_directory(directory):
+    # an open lock file holding an exclusive lock on directory, or None if
+    # another run has it (or it was removed in the meantime)
+    path = os.path.join(directory, LOCK_FILE)
+    try:
+        lock = open(path, "a")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    if not os.path.exists(path):
+        lock.close()
+        return None
+    return lock
+
+
+def evict_checkpoints(root, ttl):
+    # checkpoints of runs that were never resumed are removed after ttl
+    # seconds, unless a run is using them
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - ttl
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            lock = lock_directory(path)
+            if lock is not None:
+                shutil.rmtree(path, ignore_errors=True)
+                lock.close()
+
+
+def open_checkpoint(root, key, every=1000):
+    # the checkpoint named key, or, while other runs hold that, the first of
+    # key.1, key.2, ... that is free. A run that died left its checkpoint
+    # unlocked, so the next run of the same upload picks it up
+    slot = 0
+    while True:
+        try:
+            return Checkpoint(os.path.join(root, key if slot == 0 else f"{key}.{slot}"), every)
+        except CheckpointInUse:
+            slot += 1
+
+
+#%%
+class CheckpointInUse(Exception):
+    """Another run holds the checkpoint directory."""
+
+
+class Checkpoint:
+    """Progress of modify_csv on one upload, so a run that dies can be resumed.
+
+    Lives in a directory named by upload_key, locked for as long as the run
+    has it open, so no other run resumes or removes it. Each prepared frame
+    (rows that have been cleaned, transformed and address-checked, just
+    before validation) is saved under a name for its rows, and USPS results
+    are appended to validated.jsonl as they come in, keyed by the input row
+    they were looked up for. Both are written so a crash can leave at most a
+    torn last line, which is skipped on reading.
+    """
+
+    def __init__(self, directory, every=1000):
+        # every: distinct addresses validated between appends
+        self.directory = directory
+        self.every = max(1, every)
+        self.pending = []
+        self._validated = None
+        os.makedirs(directory, exist_ok=True)
+        self.lock = lock_directory(directory)
+        if self.lock is None:
+            raise CheckpointInUse(directory)
+        # mark the checkpoint as in use for evict_checkpoints
+        os.utime(directory)
+
+    @property
+    def validated_path(self):
+        return os.path.join(self.directory, "validated.jsonl")
+
+    def frame_path(self, name):
+        return os.path.join(self.directory, f"prepared_{name}.pkl")
+
+    def load_frame(self, name):
+        try:
+            return pd.read_pickle(self.frame_path(name))
+        except FileNotFoundError:
+            return None
+
+    def save_frame(self, df, name):
+        # written under a temporary name and renamed, so a frame on disk is
+        # always complete; returns df so it can be run as a stage
+        path = self.frame_path(name)
+        df.to_pickle(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        return df
+
+    def validated(self):
+        """Return {row label: USPS result} for every result appended before
+        this run; read once, the first time it is asked for."""
+        if self._validated is not None:
+            return self._validated
+        self._validated = {}
+        try:
+            with open(self.validated_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._validated[entry["row"]] = entry["result"]
+        except FileNotFoundError:
+            pass
+        return self._validated
+
+    def add(self, items):
+        """Queue (row label, result) pairs, appending them every `every` results."""
+        self.pending.extend(items)
+        if len(self.pending) >= self.every:
+            self.flush()
+
+    def flush(self):
+        self.append(self.pending)
+        self.pending = []
+
+    def append(self, items):
+        """Append (row label, result) pairs and flush them to disk."""
+        lines = "".join(json.dumps({"row": int(label), "result": result}) + "\n" for label, result in items)
+        if not lines:
+            return
+        with open(self.validated_path, "ab+") as f:
+            # start on a fresh line after a line torn by a crash
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        # only ever the checkpoint this run holds the lock on
+        if self.lock is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.close()
+
+    def close(self):
+        # let another run have the checkpoint, e.g. to resume it
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
@@ -0,0 +1,162 @@
+"""Transform qtool exports from the command line, several files at a time.
+
+    python cli.py uploads/ --output-dir exports --format parquet --workers 4
+    python cli.py "nightly/*.csv.gz" --output-dir exports
+
+Each input is a directory (every CSV, gzipped CSV, Parquet and Feather file
+in it) or a file name or glob pattern. Files are transformed in parallel, one
+per worker process, with the same settings from config.py as the web app.
+USPS_MAX_WORKERS and USPS_RATE_LIMIT (or --usps-rate) are shared out between
+the workers, so the run as a whole keeps to them; for that there are never
+more workers than USPS_MAX_WORKERS.
+Prints the rows, time and rows/s of every file and exits with status 1 if
+any file failed.
+"""
+#%%
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from formats import FORMATS, available_formats
+
+# files picked up from a directory
+INPUT_SUFFIXES = tuple(FORMATS.values()) + (".csv.gz",)
+
+
+def find_inputs(patterns):
+    # the files named by each directory, file name or glob pattern, in order
+    # and without duplicates; a pattern that matches nothing is an error
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # earlier exports sitting in the same directory aren't inputs
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))
+                       if name.lower().endswith(INPUT_SUFFIXES) and "_modified." not in name]
+        else:
+            matches = sorted(glob.glob(pattern))
+        matches = [path for path in matches if os.path.isfile(path)]
+        if not matches:
+            raise ValueError(f"No input files found for {pattern!r}")
+        paths += [path for path in matches if path not in paths]
+    return paths
+
+
+def check_exports(paths, output_format):
+    # two inputs such as donors.csv and donors.csv.gz would write the same export
+    from csv_transformer import export_name
+
+    seen = {}
+    for path in paths:
+        name = export_name(path, output_format)
+        if name in seen:
+            raise ValueError(f"{seen[name]} and {path} would both be exported as {name}")
+        seen[name] = path
+
+
+#%%
+def run_file(path, output_dir, output_format, chunksize, usps_processes=1, usps_rate=None):
+    # runs in a worker process: transform one file and report how it went.
+    # the USPS limits are split over the usps_processes files running at once
+    from csv_transformer import make_usps_client, modify_csv
+    from metrics import read_stages
+
+    start = time.perf_counter()
+    usps_client = None
+    try:
+        usps_client = make_usps_client(processes=usps_processes, rate_limit=usps_rate)
+        export_path = modify_csv(path, usps_client=usps_client, chunksize=chunksize, workers=1,
+                                 output_format=output_format, output_dir=output_dir)
+    except Exception as e:
+        traceback.print_exc()
+        return {"input": path, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        if usps_client is not None:
+            usps_client.close()
+    seconds = time.perf_counter() - start
+
+    stages = {stage["stage"]: stage for stage in read_stages(export_path)["stages"]}
+    return {"input": path, "export": export_path, "seconds": seconds,
+            "rows": stages["read"]["rows_out"] if "read" in stages else 0}
+
+
+def run_files(paths, output_dir, output_format, chunksize=None, workers=1, usps_rate=None):
+    # yields the result of every file as it finishes. a worker process that
+    # dies (killed for memory, os._exit) fails its file and, as the pool is
+    # then broken, the files still waiting; the ones already done stand
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_file, path, output_dir, output_format, chunksize, workers, usps_rate): path
+                   for path in paths}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {"input": futures[future], "error": f"{type(e).__name__}: {e}"}
+
+
+def rate(rows, seconds):
+    return f"{rows / seconds:,.0f} rows/s" if seconds else "-"
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="directories, files or glob patterns")
+    parser.add_argument("--output-dir", "-o", default="exports", help="where exports are written (default exports)")
+    parser.add_argument("--format", "-f", default="csv", choices=list(FORMATS), help="export format (default csv)")
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count() or 1,
+                        help="files transformed at the same time (default one per CPU)")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="rows per chunk within a file (default CHUNK_ROWS in config.py)")
+    parser.add_argument("--usps-rate", type=float, default=None,
+                        help="USPS requests per second for the whole run, split between the workers "
+                             "(default USPS_RATE_LIMIT in config.py)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="log the stage timings of every file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.usps_rate is not None and args.usps_rate <= 0:
+        parser.error("--usps-rate must be more than 0")
+    if args.format not in available_formats():
+        parser.error(f"{args.format} exports need pyarrow installed")
+    try:
+        paths = find_inputs(args.inputs)
+        check_exports(paths, args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # every worker needs at least one of the USPS_MAX_WORKERS connections
+    from csv_transformer import usps_max_workers
+
+    workers = min(args.workers, len(paths))
+    if workers > usps_max_workers():
+        print(f"--workers {args.workers} is more than USPS_MAX_WORKERS; running {usps_max_workers()} at a time",
+              file=sys.stderr)
+        workers = usps_max_workers()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    rows, failed = 0, []
+    for result in run_files(paths, args.output_dir, args.format, args.chunksize, workers, args.usps_rate):
+        if "error" in result:
+            failed.append(result["input"])
+            print(f"FAILED  {result['input']}: {result['error']}", flush=True)
+            continue
+        rows += result["rows"]
+        print(f"ok      {result['input']}: {result['rows']:,} rows in {result['seconds']:.1f}s "
+              f"({rate(result['rows'], result['seconds'])}) -> {result['export']}", flush=True)
+    seconds = time.perf_counter() - start
+
+    print(f"{len(paths) - len(failed)} of {len(paths)} files, {rows:,} rows in {seconds:.1f}s "
+          f"({rate(rows, seconds)})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
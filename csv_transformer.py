@@ -2,355 +2,579 @@
 import os
 import config
 import csv
+import heapq
+import io
+import json
 import pandas as pd
 import re
-import requests # needed for USPS API
-import xml.etree.ElementTree as ET # needed to parse USPS API returned XML
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from address_cache import AddressCache, normalize_parts
+from checkpoint import CHECKPOINTS_AVAILABLE, evict_checkpoints, open_checkpoint, upload_key
+from formats import FORMATS, check_format, convert_export, detect_format, read_columnar, write_columnar
+from matching import DuplicateIndex, names_in_text
+from metrics import StageMetrics, logger
+from record_store import RecordStore, fingerprints, record_keys
+from schema import (LENGTH_DTYPE, QTOOL_COLUMNS, UNPARSED_COLUMN, compact_text, from_text, is_text, parse_values,
+                    read_dtypes, read_types, to_text)
+from usps import (ASYNC_AVAILABLE, AsyncUSPSClient, USPSClient, USPS_API_URL, NOT_VALIDATED, RESULT_FIELDS,
+                  VALIDATION_ERROR)
+
+#%% md
+## Name Transformation Rules
+# Split and restructure names to conform with iWave requirements.
+# Each step works on whole columns at once: letter counts are computed once per
+# column and every rule is a boolean mask over the frame.
+#%%
+# regex pattern to match "and" or "&"
+AND_PATTERN = re.compile(r"\band\b|&", flags=re.IGNORECASE)
+
+# prefixes that look like initials ("Dr.", "Mr.") and must not be converted
+INITIALS_PREFIX_PATTERN = re.compile(r'^\b(Mr|Ms|Mrs|Dr|Prof|Sr|Jr)\b', flags=re.IGNORECASE)
+
+# records for families and foundations are removed, not transformed
+FAMILY_PATTERN = re.compile(r"family|foundation", flags=re.IGNORECASE)
+
+# everything classify_names looks for in FIRSTNAME, one group per flag, so a
+# single scan of a value finds all of them: hidden prefixes and suffixes, and
+# digits (which are also looked for in the rest of the full name)
+NAME_FLAGS_PATTERN = re.compile(r"(?P<prefix>\b(?:MR\.?|MS\.?|MRS\.?|DR\.?|REV\.?|PROF\.?)\b)"
+                                r"|(?P<suffix>\b(?:JR\.?|SR\.?|II\.?|III\.?|IV\.?|V\.?)\b)"
+                                r"|(?P<digit>\d)", flags=re.IGNORECASE)
+DIGIT_PATTERN = re.compile(r"\d")
+
+# letters only, i.e. str.isalpha(); \w minus digits and "_" still admits the
+# non-decimal numerals Latin-1 can decode, so those are excluded explicitly
+LETTER_PATTERN = re.compile(r"[^\W\d_\u00b9\u00b2\u00b3\u00bc\u00bd\u00be]")
+
+def alpha_counts(s):
+    # count letters in every value of a column (periods are never letters)
+    return s.str.count(LETTER_PATTERN)
+
+def transform_names(df):
+    df = df.copy()
+    first = df["FIRSTNAME"]
+
+    # split &/and names; names with more than one "&"/"and" are left alone
+    # and skip the remaining checks
+    # the split has more than one part exactly when the pattern was found
+    name_parts = first.str.split(AND_PATTERN)
+    had_and = name_parts.str.len() > 1
+    df["HAD_AND"] = had_and
+    split = had_and & (name_parts.str.len() == 2)
+    unsplit = had_and & ~split
+    df.loc[split, "FIRSTNAME"] = name_parts[split].str[0].str.strip()
+    df.loc[split, "SPOUSEFIRSTNAME"] = name_parts[split].str[1].str.strip()
+
+    first = alpha_counts(df["FIRSTNAME"])
+    middle = alpha_counts(df["MIDDLENAME_INITIAL"])
+    last = alpha_counts(df["LASTNAME"])
+    spouse_first = alpha_counts(df["SPOUSEFIRSTNAME"])
+    spouse_middle = alpha_counts(df["SPOUSEMIDDLENAME_INITIAL"])
+    spouse_last = alpha_counts(df["SPOUSELASTNAME"])
+
+    # valid names: more than one letter in FIRSTNAME and LASTNAME, or a single
+    # initial in FIRSTNAME followed by a full MIDDLENAME_INITIAL and LASTNAME
+    valid = ~unsplit & (((first > 1) & (last > 1)) | ((first == 1) & (middle > 1) & (last > 1)))
+
+    # primary name is only initials but the spouse name is valid: swap them
+    swap = ~unsplit & ~valid & (first <= 1) & (middle <= 1) & \
+        (((spouse_first > 1) & (spouse_last > 1)) |
+         ((spouse_first == 1) & (spouse_middle > 1) & (spouse_last > 1)))
+
+    # everything else needs a person to look at it
+    df["REVIEW"] = ~(valid | swap | unsplit)
+    df["TRANSFORMED"] = swap
+
+    # switch name fields with spouse name fields
+    primary = ["FIRSTNAME", "MIDDLENAME_INITIAL", "LASTNAME", "SUFFIX"]
+    spouse = ["SPOUSEFIRSTNAME", "SPOUSEMIDDLENAME_INITIAL", "SPOUSELASTNAME", "SPOUSESUFFIX"]
+    swapped = df.loc[swap, spouse + primary].to_numpy()
+    df.loc[swap, primary + spouse] = swapped
+
+    return df
+
+def check_emails(df):
+    # look for additional information in email addresses:
+    # CHECK_EMAIL is set if a record flagged for review has its LASTNAME or
+    # SPOUSELASTNAME as part of the email address. Only those records can be
+    # marked, so the names are looked for in their emails alone
+    df = df.copy()
+    candidates = df["REVIEW"] & (df["EMAIL"].str.strip() != "")
+    email = df.loc[candidates, "EMAIL"].str.lower()
+    last = df.loc[candidates, "LASTNAME"].str.lower()
+    spouse_last = df.loc[candidates, "SPOUSELASTNAME"].str.lower()
+
+    df["CHECK_EMAIL"] = False
+    df.loc[candidates, "CHECK_EMAIL"] = names_in_text(last, email) | names_in_text(spouse_last, email)
+    return df
+
+def classify_names(df):
+    # one pass over the name columns: convert initials, flag hidden prefixes,
+    # suffixes and digits for review, and strip periods
+    df = df.copy()
+    initials, prefix, suffix, digit = [], [], [], []
+    first_names, middle_names, suffixes = [], [], []
+    for first, middle, last, name_suffix in zip(df["FIRSTNAME"], df["MIDDLENAME_INITIAL"],
+                                                df["LASTNAME"], df["SUFFIX"]):
+        # convert initial first names to strings with spaces (e.g., T J instead of T.J.)
+        # apply only if there is more than one period, and not to prefixes or suffixes
+        converted = first.count(".") > 1 and not INITIALS_PREFIX_PATTERN.match(first)
+        if converted:
+            first = first.replace(".", " ")
+
+        # one (prefix, suffix, digit) tuple per match, with only one of them set
+        found = NAME_FLAGS_PATTERN.findall(first)
+        initials.append(converted)
+        prefix.append(any(match[0] for match in found))
+        suffix.append(any(match[1] for match in found))
+        # review if the full name contains a number
+        digit.append(any(match[2] for match in found) or DIGIT_PATTERN.search(middle + last + name_suffix) is not None)
+
+        first_names.append(first.replace(".", ""))
+        middle_names.append(middle.replace(".", ""))
+        suffixes.append(name_suffix.replace(".", ""))
+
+    initials = pd.Series(initials, index=df.index)
+    prefix = pd.Series(prefix, index=df.index)
+    suffix = pd.Series(suffix, index=df.index)
+    digit = pd.Series(digit, index=df.index)
+
+    df["FIRSTNAME"] = first_names
+    df["MIDDLENAME_INITIAL"] = middle_names
+    df["SUFFIX"] = suffixes
+    df["TRANSFORMED"] |= initials
+    df["PREFIX_SUSPECT"] = prefix
+    df["SUFFIX_SUSPECT"] = suffix
+    df["REVIEW"] |= prefix | suffix | digit
+
+    # strip periods from the spouse name columns
+    for column in ["SPOUSEFIRSTNAME", "SPOUSEMIDDLENAME_INITIAL", "SPOUSESUFFIX"]:
+        df[column] = df[column].str.replace(".", "", regex=False)
+    return df
 
 #%%
-def modify_csv(file_path):
-    # Generate the new file name
-    new_file_path = os.path.splitext(file_path)[0]
-    modified_file = new_file_path + "_modified.csv"
-    exports_dir = os.path.join(os.path.dirname(file_path), "../exports")
-    os.makedirs(exports_dir, exist_ok=True)
-    modified_file_path = os.path.join(exports_dir, os.path.basename(modified_file))
+def usps_max_workers():
+    return getattr(config, "USPS_MAX_WORKERS", 8)
+
+
+def make_usps_client(processes=1, rate_limit=None):
+    # worker count, batch size and rate limit can be tuned in config.py.
+    # with aiohttp installed requests go out from an asyncio client that
+    # adapts its concurrency (up to USPS_MAX_WORKERS) and stops sending while
+    # USPS is down; USPS_ASYNC = False keeps the thread pool client.
+    # USPS_MAX_WORKERS and USPS_RATE_LIMIT (or rate_limit) hold for one
+    # client; when `processes` clients run at once each gets its share
+    if processes > usps_max_workers():
+        raise ValueError(f"USPS_MAX_WORKERS ({usps_max_workers()}) can't be shared between {processes} clients")
+    rate_limit = rate_limit or getattr(config, "USPS_RATE_LIMIT", None)
+    rate_limit = rate_limit / processes if rate_limit else None
+    max_workers = usps_max_workers() // processes
+    if getattr(config, "USPS_ASYNC", ASYNC_AVAILABLE):
+        return AsyncUSPSClient(config.USPS_API_KEY,
+                               api_url=getattr(config, "USPS_API_URL", USPS_API_URL),
+                               batch_size=getattr(config, "USPS_BATCH_SIZE", 5),
+                               max_concurrency=max_workers,
+                               rate_limit=rate_limit,
+                               max_retries=getattr(config, "USPS_MAX_RETRIES", 3),
+                               timeout=getattr(config, "USPS_TIMEOUT", 10),
+                               target_latency=getattr(config, "USPS_TARGET_LATENCY", 1.0),
+                               reset_timeout=getattr(config, "USPS_CIRCUIT_RESET_SECONDS", 30))
+    return USPSClient(config.USPS_API_KEY,
+                      api_url=getattr(config, "USPS_API_URL", USPS_API_URL),
+                      batch_size=getattr(config, "USPS_BATCH_SIZE", 5),
+                      max_workers=max_workers,
+                      rate_limit=rate_limit,
+                      max_retries=getattr(config, "USPS_MAX_RETRIES", 3),
+                      timeout=getattr(config, "USPS_TIMEOUT", 10))
+
+def make_address_cache():
+    # set ADDRESS_CACHE_PATH = None in config.py to turn the cache off
+    path = getattr(config, "ADDRESS_CACHE_PATH", os.path.join("cache", "addresses.sqlite"))
+    if not path:
+        return None
+    return AddressCache(path,
+                        ttl=getattr(config, "ADDRESS_CACHE_TTL_DAYS", 90) * 24 * 3600,
+                        max_entries=getattr(config, "ADDRESS_CACHE_MAX_ENTRIES", 1_000_000))
+
+def make_record_store():
+    # set RECORD_STORE_PATH in config.py to only transform new and changed rows
+    path = getattr(config, "RECORD_STORE_PATH", None)
+    if not path:
+        return None
+    return RecordStore(path,
+                       ttl=getattr(config, "RECORD_STORE_TTL_DAYS", 90) * 24 * 3600,
+                       max_entries=getattr(config, "RECORD_STORE_MAX_ENTRIES", 5_000_000))
+
+def make_checkpoint(file_path, output_format="csv"):
+    # set CHECKPOINT_DIR = None in config.py to turn checkpoints off. Each
+    # run locks its own checkpoint, so runs of the same upload at the same
+    # time never share one
+    root = getattr(config, "CHECKPOINT_DIR", os.path.join("cache", "checkpoints"))
+    if not root or not CHECKPOINTS_AVAILABLE:
+        return None
+    evict_checkpoints(root, getattr(config, "CHECKPOINT_TTL_DAYS", 7) * 24 * 3600)
+    return open_checkpoint(root, f"{upload_key(file_path)}-{output_format}",
+                           every=getattr(config, "CHECKPOINT_ROWS", 1000))
+
+def validate_addresses(df, usps_client=None, address_cache=None, checkpoint=None, progress=None):
+    # validate every address in batched, concurrent requests and return the
+    # corrected address parts as a dataframe aligned with df.
+    # identical addresses are only looked up once, and addresses found in the
+    # cache are not sent to USPS at all.
+    # with a checkpoint, results are appended to it every checkpoint.every
+    # addresses as USPS answers, and addresses it already has results for
+    # aren't sent again.
+    # what is sent for an address is its normalized form, which is also its
+    # key, so every row with that key gets the answer its own text would
+    # have got, whichever of them comes first.
+    # progress, if given, is called as progress(rows) with the number of rows
+    # of df whose address has been looked up so far
+    parts = [normalize_parts(*address) for address in
+             zip(df["ADDRESS1"], df["ADDRESS2"], df["CITY"], df["ZIP_POSTALCODE"])]
+    keys = ["|".join(address) for address in parts]
+
+    # first row for each distinct address
+    unique = {}
+    for position, key in enumerate(keys):
+        unique.setdefault(key, position)
+
+    cached = address_cache.get_many(unique) if address_cache is not None else {}
+    missing = [key for key in unique if key not in cached]
+
+    # results an earlier, interrupted run got for rows of df
+    resumed = {}
+    if checkpoint is not None and missing:
+        validated = checkpoint.validated()
+        for key, label in zip(keys, df.index):
+            if label in validated:
+                resumed.setdefault(key, validated[label])
+        missing = [key for key in missing if key not in resumed]
+
+    rows_per_key = Counter(keys)
+    looked_up = len(keys) - sum(rows_per_key[key] for key in missing)
+    if progress is not None:
+        progress(looked_up)
+
+    fetched = {}
+    usps_stats = None
+    if missing:
+        client = usps_client or make_usps_client()
+        rows = df.iloc[[unique[key] for key in missing]]
+        # (address1, address2, address3, city, zip5) as USPSClient takes them:
+        # the street goes in USPS's Address2 and the unit in its Address1
+        addresses = [(unit, street, "", city, zipcode)
+                     for street, unit, city, zipcode in (parts[unique[key]] for key in missing)]
+
+        def on_results(start, results):
+            # answers are checkpointed as they come in, by the row they were looked up for
+            nonlocal looked_up
+            if checkpoint is not None:
+                checkpoint.add((label, result) for label, result in zip(rows.index[start:start + len(results)],
+                                                                         results)
+                               if result["VALIDATION_ERROR"] != NOT_VALIDATED)
+            if progress is not None:
+                looked_up += sum(rows_per_key[key] for key in missing[start:start + len(results)])
+                progress(looked_up)
 
-    # Load CSV data into a DataFrame
-    df = pd.read_csv(file_path, encoding='ISO-8859-1', low_memory=False)
+        try:
+            fetched = dict(zip(missing, client.validate(addresses, on_results=on_results)))
+            usps_stats = client.stats()
+        finally:
+            if checkpoint is not None:
+                checkpoint.flush()
+            if usps_client is None:
+                client.close()
+
+    # only keep answers USPS actually gave; addresses it never answered for
+    # are NOT_VALIDATED and are tried again next run
+    fetched.update(resumed)
+    if address_cache is not None:
+        address_cache.put_many((key, result) for key, result in fetched.items()
+                               if result["VALIDATION_ERROR"] != NOT_VALIDATED
+                               and (result["VALIDATION_ERROR"] or result["Zip5"]))
+
+    not_validated = sum(result["VALIDATION_ERROR"] == NOT_VALIDATED for result in fetched.values())
+    logger.info(json.dumps({"event": "address_validation", "rows": len(keys), "distinct_addresses": len(unique),
+                            "cache_hits": len(cached), "resumed": len(resumed), "cache_misses": len(missing),
+                            "not_validated": not_validated, "usps": usps_stats}))
+
+    results = []
+    for key, address3 in zip(keys, df["ADDRESS2"]):
+        result = dict(cached[key] if key in cached else fetched[key])
+        result["Address3"] = address3
+        results.append(result)
+    return pd.DataFrame(results, index=df.index, columns=RESULT_FIELDS)
+
+#%%
+# columns of the export, in order
+OUTPUT_COLUMNS = ['ROI_ID',                   # household id
+                  'ROI_FAMILY_ID',            # individual id
+                  'FIRSTNAME',                # primary person info
+                  'MIDDLENAME_INITIAL',
+                  'LASTNAME',
+                  'SUFFIX',
+                  'FULLNAME',
+                  'MAIDEN',
+                  'NICKNAME',
+                  'TITLE',
+                  'AGE',
+                  'PHONE',
+                  'EMAIL',
+                  'SPOUSEFIRSTNAME',          # partner info
+                  'SPOUSEMIDDLENAME_INITIAL',
+                  'SPOUSELASTNAME',
+                  'SPOUSESUFFIX',
+                  'SPOUSEMAIDENNAME',
+                  'SPOUSENICKNAME',
+                  'REVIEW',                   # review names
+                  'TRANSFORMED',              # indicates that names were changed
+                  'CHECK_EMAIL',              # additional name info may be in email
+                  'PREFIX_SUSPECT',           # name may contain a prefix
+                  'SUFFIX_SUSPECT',           # name may contain a suffix
+                  'HAD_AND',                  # had two names combined in original dataset
+                  'POSSIBLE_DUPLICATE',       # same person as an earlier record with another ROI_FAMILY_ID
+                  'V_VALIDATION_ERROR',
+                  'V_STREET',                 # valid address returned by the USPS API
+                  'V_STREET2',
+                  'V_CITY',
+                  'V_STATE',
+                  'V_ZIPCODE',
+                  'V_ZIP5',
+                  'V_ZIP4',
+                  'LARGESTGIFT',              # gift info
+                  'LARGESTGIFTDATE',
+                  'TOTALGIFTCOUNT',
+                  'TOTALGIFTAMOUNT',
+                  'LASTGIFTAMOUNT',
+                  'LASTGIFTDATE',
+                  'FIRSTGIFTAMOUNT',
+                  'FIRSTGIFTDATE',
+                  'UNPARSED_VALUES',          # gift info that couldn't be read as a number or date
+                  'ADDRESS1',                  # original address info
+                  'ADDRESS2',
+                  'LINE3',
+                  'LINE4',
+                  'CITY',
+                  'STATE_PROVINCE',
+                  'ZIP_POSTALCODE',
+                  'COUNTRY',
+                  'BUSINESS',
+                  'FIRSTNAME_LEN',              # name length columns
+                  'MIDDLE_LEN',
+                  'LASTNAME_LEN',
+                  'SPOUSE_FIRSTNAME_LEN',
+                  'SPOUSE_MIDDLE_LEN',
+                  'SPOUSELASTNAME_LEN']
+
+# export columns modify_csv works out afresh; an earlier export given as
+# input is read without them
+DERIVED_COLUMNS = [column for column in OUTPUT_COLUMNS if column not in QTOOL_COLUMNS and column != UNPARSED_COLUMN]
+
+# sort to make review easier
+SORT_COLUMNS = ['REVIEW', 'CHECK_EMAIL', 'FIRSTNAME', 'MIDDLENAME_INITIAL', 'LASTNAME']
+SORT_ASCENDING = [False, False, True, True, True]
+
+# valid US state abbreviations; territories and APO addresses are dropped
+US_STATES = {'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL', 'GA', 'HI', 'ID',
+             'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO',
+             'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA',
+             'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'}
+
+# most sorted runs merged at once; more are merged in several passes
+MAX_MERGE_RUNS = 64
+
+# smallest partition worth sending to another process
+MIN_PARTITION_ROWS = 5000
+
+# rows per chunk when streaming and CHUNK_ROWS isn't set
+STREAM_CHUNK_ROWS = 10_000
+
+# least time between progress reports while addresses are validated
+PROGRESS_SECONDS = 1.0
+
+# first bytes of every gzip file
+GZIP_MAGIC = b"\x1f\x8b"
 
+#%%
+class _Prefixed(io.RawIOBase):
+    # a binary stream with bytes already read from it put back in front
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            size = min(len(buffer), len(self.head))
+            buffer[:size], self.head = self.head[:size], self.head[size:]
+            return size
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def open_records(source):
+    # a path or a binary file object (such as a request body) to read records
+    # from, and its compression: gzip input is recognised by its first bytes,
+    # whatever the file is called
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            head = f.read(len(GZIP_MAGIC))
+        return source, 'gzip' if head == GZIP_MAGIC else None
+    head = source.read(len(GZIP_MAGIC))
+    return io.BufferedReader(_Prefixed(head, source)), 'gzip' if head == GZIP_MAGIC else None
+
+def read_records(source, chunksize=None):
+    # load every column as text so each chunk gets the same types (compact
+    # Arrow strings for the columns no stage rewrites, see schema.py); gift
+    # fields are parsed in clean_records. Returns a DataFrame, or an iterator
+    # of DataFrames when chunksize is given.
+    # source is a path or a binary file object and may be gzip-compressed;
+    # Parquet and Feather files (such as earlier exports) are read as they are
+    if isinstance(source, (str, os.PathLike)) and detect_format(source):
+        records = read_columnar(source, chunksize=chunksize)
+        return read_types(records) if chunksize is None else map(read_types, records)
+    source, compression = open_records(source)
+    return pd.read_csv(source, encoding='ISO-8859-1', dtype=defaultdict(lambda: str, read_dtypes()),
+                       low_memory=False, chunksize=chunksize, compression=compression)
+
+def text_columns(df):
+    return [column for column, dtype in df.dtypes.items() if is_text(column, dtype)]
+
+def strip_whitespace(df):
+    # remove leading/trailing whitespace in all text columns, one column at a time
+    for column in text_columns(df):
+        df[column] = df[column].str.strip()
+    return df
+
+def clean_records(df):
     # make sure blanks are blank
-    df = df.fillna('')
+    df = df.fillna({column: '' for column in text_columns(df)})
 
     # drop all rows that are completely blank
     df.dropna(how='all', inplace=True)
 
-    # remove leading/trailing whitespace in all columns
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    # remove leading/trailing whitespace in all columns, then read the gift
+    # amounts, dates and counts
+    df = strip_whitespace(df)
+    df = parse_values(df)
 
-    # drop prefix columns because we won't be using them
-    df = df.drop(columns=['PREFIX', 'SPOUSEPREFIX'])
+    # drop prefix columns because we won't be using them (exports have none),
+    # and the columns an earlier run added
+    df = df.drop(columns=['PREFIX', 'SPOUSEPREFIX'] + DERIVED_COLUMNS, errors='ignore')
 
-    # Remove any records containing the word "family"
-    df = df[~df[['FIRSTNAME','LASTNAME', 'SUFFIX', 'SPOUSEFIRSTNAME','SPOUSELASTNAME', \
-                 'SPOUSESUFFIX']].apply(lambda x: x.str.contains(' family|family |family', case=False)).any(axis=1)]
+    # Remove any records containing the word "family" or "foundation"
+    names = ['FIRSTNAME', 'LASTNAME', 'SUFFIX', 'SPOUSEFIRSTNAME', 'SPOUSELASTNAME', 'SPOUSESUFFIX']
+    family = pd.concat([df[column].str.contains(FAMILY_PATTERN) for column in names], axis=1).any(axis=1)
+    df = df[~family]
+    return df
 
-    # Remove any records containing the word "foundation"
-    df = df[~df[['FIRSTNAME','LASTNAME', 'SUFFIX', 'SPOUSEFIRSTNAME','SPOUSELASTNAME', \
-                 'SPOUSESUFFIX']].apply(lambda x: x.str.contains(' foundation|foundation |foundation', case=False)).any(axis=1)]
-    #%% md
-    ## Name Transformations
-    # Split and restructure names to conform with iWave requirements
-    #%%
-    # mark the records that have two names
-    # use regex to match "and" or "&"
-    df['HAD_AND'] = df['FIRSTNAME'].apply(lambda x: bool(re.search(r'\band\b|&', x, flags=re.IGNORECASE)))
-    #%%
-    # define function to count characters and ignore periods
-
-    def alpha_count(s):
-        return sum(c.isalpha() for c in s.replace(".", ""))
-
-    # define function to transform names
-
-    def transform_name(row):
-        # define regex pattern to match "and" or "&"
-        pattern = re.compile(r"\band\b|&", flags=re.IGNORECASE)
-
-        # split &/and names
-        if pattern.search(row["FIRSTNAME"]):
-            # Split the FIRSTNAME string on "&" or "and"
-            name_parts = pattern.split(row["FIRSTNAME"])
-            if len(name_parts) == 2:
-                row["FIRSTNAME"] = name_parts[0].strip()
-                row["SPOUSEFIRSTNAME"] = name_parts[1].strip()
-            else:
-                row["REVIEW"] = "N"
-                return row
-
-        # if either of the following two conditions are true, mark the row REVIEW = "N" and TRANSFORMED = "N":
-        # 1. more than 1 character in FIRSTNAME and more than one character in LASTNAME
-        # 2. 1 character in FIRSTNAME and more than one character in MIDDLENAME_INITIAL and more than one character in LASTNAME
-
-        # check for valid names
-        if (alpha_count(row["FIRSTNAME"]) > 1  and alpha_count(row["LASTNAME"]) > 1) or \
-                (alpha_count(row["FIRSTNAME"]) == 1 and alpha_count(row["MIDDLENAME_INITIAL"]) > 1 and \
-                 alpha_count(row["LASTNAME"]) > 1):
-            row["REVIEW"] = "N"
-            row["TRANSFORMED"] = "N"
-            return row
-
-        # check for valid names with spouse info
-        elif (alpha_count(row["FIRSTNAME"]) <= 1 and alpha_count(row["MIDDLENAME_INITIAL"]) <= 1) and \
-                ((alpha_count(row["SPOUSEFIRSTNAME"]) > 1 and alpha_count(row["SPOUSELASTNAME"]) > 1) or \
-                 (alpha_count(row["SPOUSEFIRSTNAME"]) == 1 and alpha_count(row["SPOUSEMIDDLENAME_INITIAL"]) > 1 and \
-                  alpha_count(row["SPOUSELASTNAME"]) > 1)):
-
-            # store original name fields
-            orig_firstname = row["FIRSTNAME"]
-            orig_middlename = row["MIDDLENAME_INITIAL"]
-            orig_lastname = row["LASTNAME"]
-            orig_suffix = row["SUFFIX"]
-
-            # switch name fields with spouse name fields
-            row["FIRSTNAME"] = row["SPOUSEFIRSTNAME"]
-            row["MIDDLENAME_INITIAL"] = row["SPOUSEMIDDLENAME_INITIAL"]
-            row["LASTNAME"] = row["SPOUSELASTNAME"]
-            row["SUFFIX"] = row["SPOUSESUFFIX"]
-
-            # write original name fields into spouse name fields
-            row["SPOUSEFIRSTNAME"] = orig_firstname
-            row["SPOUSEMIDDLENAME_INITIAL"] = orig_middlename
-            row["SPOUSELASTNAME"] = orig_lastname
-            row["SPOUSESUFFIX"] = orig_suffix
-
-            row["REVIEW"] = "N"
-            row["TRANSFORMED"] = "Y"
-            return row
-
-        # check for invalid names
-        elif (alpha_count(row["FIRSTNAME"]) <= 1 and alpha_count(row["MIDDLENAME_INITIAL"]) <= 1) or \
-                (alpha_count(row["LASTNAME"]) <= 1):
-            row["REVIEW"] = "Y"
-            row["TRANSFORMED"] = "N"
-            return row
-    #%%
-    # define a function to look for additional information in email addresses
-
-    def check_email(row):
-        if pd.isnull(row["EMAIL"]) or row["EMAIL"].strip() == "":
-            row['CHECK_EMAIL'] = 'N'
-            return row
-
-        if row["REVIEW"]== "N":
-            row['CHECK_EMAIL'] = 'N'
-            return row
-
-        # CHECK_EMAIL = "Y" if LASTNAME is part of the email address
-        if row["LASTNAME"].lower() in row["EMAIL"].lower() and len(row["LASTNAME"]) > 1 or \
-                row["SPOUSELASTNAME"].lower() in row["EMAIL"].lower() and len(row["SPOUSELASTNAME"]) > 1:
-            row['CHECK_EMAIL'] = 'Y'
-            return row
-    #%%
-    # define a function to convert initial first names to strings with spaces (e.g., T J instead of T.J.)
-    # don't apply this to prefixes or suffixes
-    pattern = re.compile(r'^\b(Mr|Ms|Mrs|Dr|Prof|Sr|Jr)\b', flags=re.IGNORECASE)
-
-    def convert_initials(row):
-        # apply only if there is more than one period
-        if pd.notnull(row["FIRSTNAME"]) and row["FIRSTNAME"].count('.') > 1 and \
-                not re.match(pattern, row["FIRSTNAME"]):
-            row['TRANSFORMED'] = 'Y'
-            row['FIRSTNAME'] = re.sub(r'\.', ' ', row["FIRSTNAME"])
-        return row
-
-    # trim white space again
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-    #%%
-    # Treat the name and ID columns as strings
-    cols_to_convert = list(range(7))
-    df.iloc[:, cols_to_convert] = df.iloc[:, cols_to_convert].astype(str)
+#%% md
+## Name Transformations
+# Split and restructure names to conform with iWave requirements
+#%%
+def transform_records(df):
     #%% md
     #**Run Functions**
     #%%
-    # apply name transformations
-    df = df.apply(transform_name, axis=1)
+    # apply name transformations; this also marks the records that had two
+    # names ("and" or "&") in HAD_AND
+    df = transform_names(df)
     #%%
     # apply email checker
-    df = df.apply(check_email, axis=1)
-    #%%
-    # apply initial converter
-    df = df.apply(convert_initials, axis=1)
+    df = check_emails(df)
     #%%
-    # mark split names as TRANSFORMED
-    # boolean indexing to mark rows as 'Y' when HAD_AND = True
-    df.loc[df['HAD_AND'] == True, 'HAD_AND'] = 'Y'
-    df.loc[df['HAD_AND'] == False, 'HAD_AND'] = 'N'
-    #%%
-    # mark records with suspected prefixes and suffixes hidden in FIRSTNAME
-    df['PREFIX_SUSPECT'] = df['FIRSTNAME'].str.extract(r'\b(MR\.?|MS\.?|MRS\.?|DR\.?|REV\.?|PROF\.?)\b', \
-                                                       flags=re.IGNORECASE, expand=False).notnull().map({True: 'Y', False: 'N'})
-    df['SUFFIX_SUSPECT'] = df['FIRSTNAME'].str.extract(r'\b(JR\.?|SR\.?|II\.?|III\.?|IV\.?|V\.?)\b', \
-                                                       flags=re.IGNORECASE, expand=False).notnull().map({True: 'Y', False: 'N'})
-
-    prefix_suspects = df.loc[df['PREFIX_SUSPECT'] == 'Y']
-    suffix_suspects = df.loc[df['SUFFIX_SUSPECT'] == 'Y']
-
-    # mark prefix and suffix suspects for review
-    df.loc[df['PREFIX_SUSPECT'] == 'Y', 'REVIEW'] = 'Y'
-    df.loc[df['SUFFIX_SUSPECT'] == 'Y', 'REVIEW'] = 'Y'
-    #%%
-    # strip periods from name columns
-    df['FIRSTNAME'] = df['FIRSTNAME'].str.replace('.', '')
-    df['SPOUSEFIRSTNAME'] = df['SPOUSEFIRSTNAME'].str.replace('.', '')
-    df['MIDDLENAME_INITIAL'] = df['MIDDLENAME_INITIAL'].str.replace('.', '')
-    df['SUFFIX'] = df['SUFFIX'].str.replace('.', '')
-    df['SPOUSEMIDDLENAME_INITIAL'] = df['SPOUSEMIDDLENAME_INITIAL'].str.replace('.', '')
-    df['SPOUSESUFFIX'] = df['SPOUSESUFFIX'].str.replace('.', '')
+    # convert initials, mark suspected prefixes, suffixes and digits for
+    # review and strip periods from name columns
+    df = classify_names(df)
     #%%
     # create fullname column
     df['FULLNAME'] = df['FIRSTNAME'].str.cat(df['MIDDLENAME_INITIAL'], \
                                              sep=' ', na_rep='').str.cat(df['LASTNAME'], \
                                                                          sep=' ', na_rep='').str.cat(df['SUFFIX'], sep=' ', na_rep='')
-    # review if fullname contains a number
-    df.loc[df['FULLNAME'].str.contains('\d', regex=True), 'REVIEW'] = 'Y'
 
     #%%
     # create reference columns so Excel can sort on length of names
-    df['FIRSTNAME_LEN'] = df['FIRSTNAME'].str.len()
-    df['MIDDLE_LEN'] = df['MIDDLENAME_INITIAL'].str.len()
-    df['LASTNAME_LEN'] = df['LASTNAME'].str.len()
-    df['SPOUSE_FIRSTNAME_LEN'] = df['SPOUSEFIRSTNAME'].str.len()
-    df['SPOUSE_MIDDLE_LEN'] = df['SPOUSEMIDDLENAME_INITIAL'].str.len()
-    df['SPOUSELASTNAME_LEN'] = df['SPOUSELASTNAME'].str.len()
-    #%% md
-    ## Address Cleanup
-    # Limit geographic scope and validate addresses using USPS API
-    #%%
+    df['FIRSTNAME_LEN'] = df['FIRSTNAME'].str.len().astype(LENGTH_DTYPE)
+    df['MIDDLE_LEN'] = df['MIDDLENAME_INITIAL'].str.len().astype(LENGTH_DTYPE)
+    df['LASTNAME_LEN'] = df['LASTNAME'].str.len().astype(LENGTH_DTYPE)
+    df['SPOUSE_FIRSTNAME_LEN'] = df['SPOUSEFIRSTNAME'].str.len().astype(LENGTH_DTYPE)
+    df['SPOUSE_MIDDLE_LEN'] = df['SPOUSEMIDDLENAME_INITIAL'].str.len().astype(LENGTH_DTYPE)
+    df['SPOUSELASTNAME_LEN'] = df['SPOUSELASTNAME'].str.len().astype(LENGTH_DTYPE)
+
+    return df
+
+#%% md
+## Address Cleanup
+# Limit geographic scope and validate addresses using USPS API
+#%%
+def check_addresses(df):
     # Keep only US
     df = df[df['COUNTRY'] == 'US']
 
     # Drop territories/APO addresses
-    df = df[~df['STATE_PROVINCE'].isin(['VI', 'PR', 'GU', 'AS'])]
+    df = df[~df['STATE_PROVINCE'].isin(['VI', 'PR', 'GU', 'AS'])].copy()
 
     # Create columns for checking address problems
-    df['STATE_INVALID'] = 'N'
-    df['ADDRESS_BLANK'] = 'N'
-    df['ADDRESS_INCOMPLETE'] = 'N'
-
     # Replace "#" with "Unit"
     df["ADDRESS2"] = df["ADDRESS2"].str.replace("# ", "Unit ")
     df["ADDRESS2"] = df["ADDRESS2"].str.replace("#", "Unit ")
     #%%
-    # define a set of valid US state and territory abbreviations
-    us_states_abbrev = set(['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL', 'GA', 'HI', 'ID',
-                            'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO',
-                            'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA',
-                            'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'])
-
-    # iterate through each row in the dataframe
-    for i, row in df.iterrows():
-        address_line1 = row['ADDRESS1'].strip().rstrip('.')
-        address_line2 = row['ADDRESS2'].strip().rstrip('.')
-        city = row['CITY'].strip()
-        state = row['STATE_PROVINCE'].strip().upper()
-        zipcode = row['ZIP_POSTALCODE'].strip()
-
-        # check if all address columns are blank
-        if address_line1 == '' and address_line2 == '' and city == '' and state == '' and zipcode == '':
-            df.at[i, 'ADDRESS_BLANK'] = 'Y'
-            df.at[i, 'STATE_INVALID'] = 'Y'  # Mark STATE_INVALID as 'Y' for blank addresses
-            continue
-
-        # validate the state abbreviation
-        if pd.isnull(state) or state.strip() == '' or state.strip().upper() not in us_states_abbrev:
-            df.at[i, 'STATE_INVALID'] = 'Y'
-            df.at[i, 'ADDRESS_INCOMPLETE'] = 'Y'
-        continue
-
-        # check if any necessary address columns are blank
-        if pd.isnull(address_line1) or address_line1 == '' or pd.isnull(zipcode) or zipcode == '' or \
-                pd.isnull(state) or state == '':
-            df.at[i, 'ADDRESS_INCOMPLETE'] = 'Y'
-            continue
-
-        # construct the full address
-        full_address_parts = []
-        if address_line1 != '':
-            full_address_parts.append(address_line1)
-        if address_line2 != '':
-            full_address_parts.append(address_line2)
-        if city != '':
-            full_address_parts.append(city)
-        if state != '':
-            full_address_parts.append(state)
-        if zipcode != '':
-            full_address_parts.append(zipcode)
-
-        # update the row with modified address values
-        df.at[i, 'ADDRESS1'] = address_line1
-        df.at[i, 'ADDRESS2'] = address_line2
-
-        # join the address parts with commas
-        df.at[i, 'FULL_ADDRESS'] = ', '.join(full_address_parts)
+    # normalized address parts used by the checks below
+    address_line1 = df['ADDRESS1'].str.strip().str.rstrip('.')
+    address_line2 = df['ADDRESS2'].str.strip().str.rstrip('.')
+    city = df['CITY'].str.strip()
+    state = df['STATE_PROVINCE'].str.strip().str.upper()
+    zipcode = df['ZIP_POSTALCODE'].str.strip()
+
+    # check if all address columns are blank
+    blank = (address_line1 == '') & (address_line2 == '') & (city == '') & (state == '') & (zipcode == '')
+
+    # validate the state abbreviation
+    state_invalid = ~blank & ~state.isin(US_STATES)
+
+    # check if any necessary address columns are blank (a blank state is already invalid)
+    incomplete = ~blank & ~state_invalid & ((address_line1 == '') | (zipcode == ''))
+    complete = ~blank & ~state_invalid & ~incomplete
+
+    df['ADDRESS_BLANK'] = blank
+    df['STATE_INVALID'] = blank | state_invalid  # blank addresses have no valid state either
+    df['ADDRESS_INCOMPLETE'] = state_invalid | incomplete
+
+    # update complete addresses with the trimmed address lines
+    df.loc[complete, 'ADDRESS1'] = address_line1[complete]
+    df.loc[complete, 'ADDRESS2'] = address_line2[complete]
+
+    # construct the full address by joining the non-blank parts with commas
+    full_address = pd.Series('', index=df.index)
+    for part in [address_line1, address_line2, city, state, zipcode]:
+        full_address += (', ' + part).where(part != '', '')
+    df['FULL_ADDRESS'] = full_address.str[2:].where(complete, '')
 
     # reset the value for ADDRESS_BLANK where ADDRESS_INCOMPLETE is marked
-    df.loc[df['ADDRESS_INCOMPLETE'] == 'Y', 'ADDRESS_BLANK'] = 'N'
+    df.loc[df['ADDRESS_INCOMPLETE'], 'ADDRESS_BLANK'] = False
 
     # write blank addresses to their own df
     # if we need to check the blanks they're stored in blank_addresses
-    blank_addresses = df.loc[df['ADDRESS_BLANK'] == "Y"]
+    blank_addresses = df.loc[df['ADDRESS_BLANK']]
 
     # drop all the records with blank addresses
-    df = df[df['ADDRESS_BLANK'] != 'Y']
+    df = df[~df['ADDRESS_BLANK']]
 
-    # drop the ADDRESS_BLANK column (they all are "N" now)
+    # drop the ADDRESS_BLANK column (they are all unset now)
     df = df.drop("ADDRESS_BLANK", axis=1)
-    #%% md
-    #USPS API
-    #%%
-    # define function to use USPS API to return validated addresses
-    def validate_address(address1, address2, address3, city, zip_postalcode):
-        api_url = "https://secure.shippingapis.com/ShippingAPI.dll"
-        username = config.USPS_API_KEY
-
-        params = {
-            "API": "Verify",
-            "XML": f"<AddressValidateRequest USERID='{username}'>"
-                   f"<Address ID='0'>"
-                   f"<Address1>{address1}</Address1>"
-                   f"<Address2>{address2}</Address2>"
-                   f"<City>{city}</City>"
-                   f"<State></State>"
-                   f"<Zip5>{zip_postalcode}</Zip5>"
-                   f"<Zip4></Zip4>"
-                   f"</Address>"
-                   f"</AddressValidateRequest>"
-        }
 
-        try:
-            response = requests.get(api_url, params=params)
-            response.raise_for_status()
-            parsed_response = ET.fromstring(response.text)
-
-            corrected_address_parts = {}
-            corrected_address_parts["Address2"] = parsed_response.findtext(".//Address2")
-            corrected_address_parts["Address3"] = address3
-            corrected_address_parts["City"] = parsed_response.findtext(".//City")
-            corrected_address_parts["State"] = parsed_response.findtext(".//State")
-            corrected_address_parts["Zip5"] = parsed_response.findtext(".//Zip5")
-            corrected_address_parts["Zip4"] = parsed_response.findtext(".//Zip4")
-
-            # Create the "VALIDATION_ERROR" column and fill it with None
-            result = pd.Series(corrected_address_parts, name="VALIDATION_ERROR")
-            result["VALIDATION_ERROR"] = None
-
-            error = parsed_response.find(".//Error")
-            if error is not None:
-                # Set the error message in the "VALIDATION_ERROR" column
-                result["VALIDATION_ERROR"] = "Check original address for errors"
-
-            return result
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error occurred during address validation: {e}")
-            # Create the "VALIDATION_ERROR" column and fill it with None
-            result = pd.Series([None], name="VALIDATION_ERROR")
-            result["VALIDATION_ERROR"] = None
-            return result
-
-    #%% md
-    #**Execute address validation on the full dataset**
-    #%%
-
-    # Create a new dataframe to store the validated address parts
-    validated_addresses = df.apply(
-        lambda row: validate_address(
-            row["FULLNAME"], row["ADDRESS1"], row["ADDRESS2"], row["CITY"], row["ZIP_POSTALCODE"]
-        ),
-        axis=1
-    )
+    return df
 
+#%%
+def finalize_records(df, validated_addresses):
+    # attach the USPS results and shape the export columns
     # Rename the columns in the validated_addresses dataframe
     validated_addresses.columns = ["v_" + column for column in validated_addresses.columns]
 
@@ -358,14 +582,15 @@ def modify_csv(file_path):
     df = pd.concat([df, validated_addresses], axis=1)
 
     # create combined zipcode column
-    df["v_zipcode"] = df.apply(lambda row: f"{row['v_Zip5']}-{row['v_Zip4']}" if row['v_Zip5'] and \
-                                                                                 row['v_Zip4'] else '', axis=1)
+    zip5 = df['v_Zip5'].fillna('')
+    zip4 = df['v_Zip4'].fillna('')
+    df["v_zipcode"] = (zip5 + "-" + zip4).where((zip5 != '') & (zip4 != ''), '')
 
     # Drop columns that are no longer needed
     df = df.drop(columns=['STATE_INVALID', 'ADDRESS_INCOMPLETE'])
 
     # make sure blanks are blank
-    df = df.fillna('')
+    df = df.fillna({column: '' for column in text_columns(df)})
 
     # cleanup columns
     # consistent capitalization
@@ -374,79 +599,379 @@ def modify_csv(file_path):
     # incorporate apt/unit it into validated address
     df['V_STREET2'] = df['ADDRESS2'].str.upper()
 
-    # make V_STREET2 blank when validation error occurs
-    df.loc[df['V_VALIDATION_ERROR'] == 'Check original address for errors', 'V_STREET2'] = ''
+    # make V_STREET2 blank when validation error occurs or USPS never answered
+    df.loc[df['V_VALIDATION_ERROR'].isin([VALIDATION_ERROR, NOT_VALIDATED]), 'V_STREET2'] = ''
 
     # mark validation errors for review
-    df.loc[df['V_VALIDATION_ERROR'] == 'Check original address for errors', 'REVIEW'] = 'Y'
+    df.loc[df['V_VALIDATION_ERROR'] == VALIDATION_ERROR, 'REVIEW'] = True
 
     # rename street address column to conform with original address column names
     df = df.rename({'V_ADDRESS2': 'V_STREET'}, axis=1)
 
-    # reorder
-    df = df[['ROI_ID', # household id
-             'ROI_FAMILY_ID',            # individual id
-             'FIRSTNAME',                # primary person info
-             'MIDDLENAME_INITIAL',
-             'LASTNAME',
-             'SUFFIX',
-             'FULLNAME',
-             'MAIDEN',
-             'NICKNAME',
-             'TITLE',
-             'AGE',
-             'PHONE',
-             'EMAIL',
-             'SPOUSEFIRSTNAME',          # partner info
-             'SPOUSEMIDDLENAME_INITIAL',
-             'SPOUSELASTNAME',
-             'SPOUSESUFFIX',
-             'SPOUSEMAIDENNAME',
-             'SPOUSENICKNAME',
-             'REVIEW',                   # review names
-             'TRANSFORMED',              # indicates that names were changed
-             'CHECK_EMAIL',              # additional name info may be in email
-             'PREFIX_SUSPECT',           # name may contain a prefix
-             'SUFFIX_SUSPECT',           # name may contain a suffix
-             'HAD_AND',                  # had two names combined in original dataset
-             'V_VALIDATION_ERROR',
-             'V_STREET',                 # valid address returned by the USPS API
-             'V_STREET2',
-             'V_CITY',
-             'V_STATE',
-             'V_ZIPCODE',
-             'V_ZIP5',
-             'V_ZIP4',
-             'LARGESTGIFT',              # gift info
-             'LARGESTGIFTDATE',
-             'TOTALGIFTCOUNT',
-             'TOTALGIFTAMOUNT',
-             'LASTGIFTAMOUNT',
-             'LASTGIFTDATE',
-             'FIRSTGIFTAMOUNT',
-             'FIRSTGIFTDATE',
-             'ADDRESS1',                  # original address info
-             'ADDRESS2',
-             'LINE3',
-             'LINE4',
-             'CITY',
-             'STATE_PROVINCE',
-             'ZIP_POSTALCODE',
-             'COUNTRY',
-             'BUSINESS',
-             'FIRSTNAME_LEN',              # name length columns
-             'MIDDLE_LEN',
-             'LASTNAME_LEN',
-             'SPOUSE_FIRSTNAME_LEN',
-             'SPOUSE_MIDDLE_LEN',
-             'SPOUSELASTNAME_LEN']]
+    # set across the whole file by flag_duplicates
+    df['POSSIBLE_DUPLICATE'] = False
 
+    # reorder, with the text that is finished now held compactly
+    df = compact_text(df[OUTPUT_COLUMNS].copy())
+
+    return df
+
+#%%
+def prepare_records(df):
+    # the CPU-bound row-level stages, run before address validation
+    df = clean_records(df)
+    df = transform_records(df)
+    return check_addresses(df)
+
+def prepare_records_parallel(df, pool, workers):
+    # split the frame into one partition per worker, prepare them in the
+    # process pool and put them back together in their original order; every
+    # stage is row-local, so the result is the same as prepare_records(df)
+    size = -(-len(df) // workers)
+    partitions = [df.iloc[start:start + size] for start in range(0, len(df), size)]
+    return pd.concat(list(pool.map(prepare_records, partitions)))
+
+def lookup_records(df, record_store):
+    # the stored export row (or None, for rows that were filtered out) of
+    # every row of df that is unchanged since it was stored, by index label
+    record_store.use_schema(df.columns, OUTPUT_COLUMNS)
+    keys = record_keys(df)
+    stored = record_store.get_many({key for key in keys if key is not None})
+    unchanged = {label: stored[key][1] for label, key, fingerprint in zip(df.index, keys, fingerprints(df))
+                 if key in stored and stored[key][0] == fingerprint}
+    return pd.Series(unchanged, index=list(unchanged), dtype=object)
+
+def store_records(df, processed, record_store):
+    # remember the export row each input row of df produced; rows missing
+    # from processed were filtered out and are stored as such. Rows whose
+    # address USPS never answered for aren't stored, so the next run tries again
+    outputs = dict(zip(processed.index, to_text(processed).astype(object).fillna('').values.tolist()))
+    retry = set(processed.index[processed['V_VALIDATION_ERROR'] == NOT_VALIDATED])
+    record_store.put_many((key, fingerprint, outputs.get(label))
+                          for label, key, fingerprint in zip(df.index, record_keys(df), fingerprints(df))
+                          if key is not None and label not in retry)
+    return processed
+
+def checkpoint_name(df):
+    # names the prepared frame of a set of input rows within a checkpoint
+    return f"{df.index[0]}-{df.index[-1]}-{len(df)}"
+
+def process_records(df, usps_client, address_cache=None, metrics=None, pool=None, workers=1, record_store=None,
+                    checkpoint=None, progress=None):
+    # run every row-level stage; rows never depend on other rows here, so a
+    # chunk of the input can be processed on its own.
+    # each stage is timed through metrics (a StageMetrics).
+    # with a process pool, the stages before validation are spread over workers.
+    # with a record store, only new and changed rows go through the stages;
+    # the stored export rows of the rest are put back in their place.
+    # with a checkpoint, the prepared rows and validation results are saved as
+    # they are produced, and whatever an interrupted run saved is reused.
+    # progress, if given, is called as progress(rows) with the rows of df
+    # validated so far, as USPS answers
+    metrics = metrics or StageMetrics()
+    if record_store is not None:
+        unchanged = metrics.run("lookup", lookup_records, df, record_store)
+        changed = df[~df.index.isin(unchanged.index)]
+        frames = [from_text(pd.DataFrame(unchanged.dropna().tolist(), columns=OUTPUT_COLUMNS,
+                                         index=unchanged.dropna().index))]
+        if not changed.empty:
+            # stored rows count as done
+            stored = len(df) - len(changed)
+            processed = process_records(changed, usps_client, address_cache, metrics=metrics, pool=pool,
+                                        workers=workers, checkpoint=checkpoint,
+                                        progress=None if progress is None else lambda rows: progress(stored + rows))
+            frames.append(metrics.run("store", store_records, changed, processed, record_store))
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame(columns=OUTPUT_COLUMNS)
+        # back in input order, so ties sort exactly as in a full run
+        return pd.concat(frames).sort_index()
+
+    rows_in = len(df)
+    name = checkpoint_name(df) if checkpoint is not None and len(df) else None
+    prepared = checkpoint.load_frame(name) if name is not None else None
+    if prepared is not None:
+        logger.info(json.dumps({"event": "checkpoint_resumed", "rows": name, "prepared_rows": len(prepared)}))
+        df = prepared
+    elif pool is not None and workers > 1 and len(df) >= workers * MIN_PARTITION_ROWS:
+        df = metrics.run("prepare", prepare_records_parallel, df, pool, workers)
+    else:
+        df = metrics.run("clean", clean_records, df)
+        df = metrics.run("names", transform_records, df)
+        df = metrics.run("addresses", check_addresses, df)
+    if prepared is None and name is not None:
+        metrics.run("checkpoint", checkpoint.save_frame, df, name)
+    if progress is not None:
+        # rows dropped before validation (blank or foreign addresses) count as done
+        dropped = rows_in - len(df)
+        validated = progress
+        progress = lambda rows: validated(dropped + rows)
+    validated_addresses = metrics.run("validation", validate_addresses, df, usps_client, address_cache, checkpoint,
+                                      progress)
+    return metrics.run("finalize", finalize_records, df, validated_addresses)
+
+def flag_duplicates(df, duplicate_index):
+    # mark records that look like a person already seen in this file under
+    # another ROI_FAMILY_ID; duplicate_index (a DuplicateIndex) carries the
+    # records seen so far from one chunk to the next, so rows must come in
+    # input order
+    df['POSSIBLE_DUPLICATE'] = duplicate_index.flag(df)
+    return df
+
+def sort_records(df):
     # sort to make review easier
-    df = df.sort_values(by=['REVIEW', 'CHECK_EMAIL', 'FIRSTNAME', 'MIDDLENAME_INITIAL', 'LASTNAME'],
-                        ascending=[False, False, True, True, True])
+    return df.sort_values(by=SORT_COLUMNS, ascending=SORT_ASCENDING)
+
+def write_records(df, path, header=True, output_format="csv"):
+    # Save the modified DataFrame to a CSV file (or any text buffer), or to a
+    # Parquet or Feather file with typed gift, count and length columns.
+    # flags are written as "Y"/"N"
+    if output_format == "csv":
+        to_text(df).to_csv(path, index=False, header=header)
+    else:
+        write_columnar(df, path, output_format)
+    return df
 
-    #%%
-    # Save the modified DataFrame to a new CSV file
-    df.to_csv(modified_file_path, index=False)
+#%%
+class _Descending:
+    # reverses the ordering of a sort key value
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def merge_sorted_runs(run_paths, output_path, tmp_dir):
+    # k-way merge of CSV files that were each written by sort_records; only
+    # one row per file is held in memory. heapq.merge is stable, so ties keep
+    # their input order exactly as a single sort_values would.
+    # returns the number of rows written
+    while len(run_paths) > MAX_MERGE_RUNS:
+        merged = []
+        for i in range(0, len(run_paths), MAX_MERGE_RUNS):
+            path = os.path.join(tmp_dir, f"merge_{len(merged)}_{os.path.basename(run_paths[i])}")
+            merge_sorted_runs(run_paths[i:i + MAX_MERGE_RUNS], path, tmp_dir)
+            merged.append(path)
+        run_paths = merged
+
+    files = [open(path, newline='', encoding='utf-8') for path in run_paths]
+    try:
+        readers = [csv.reader(f) for f in files]
+        header = [next(reader) for reader in readers][0]
+        positions = [header.index(column) for column in SORT_COLUMNS]
+
+        def sort_key(row):
+            return tuple(row[p] if ascending else _Descending(row[p])
+                         for p, ascending in zip(positions, SORT_ASCENDING))
+
+        with open(output_path, 'w', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out, lineterminator=os.linesep)
+            writer.writerow(header)
+            rows = 0
+            for row in heapq.merge(*readers, key=sort_key):
+                writer.writerow(row)
+                rows += 1
+    finally:
+        for f in files:
+            f.close()
+    return rows
 
-    return modified_file_path
\ No newline at end of file
+#%%
+def export_name(filename, output_format="csv"):
+    # <name>_modified.csv for an upload called <name>.csv or <name>.csv.gz,
+    # or .parquet/.feather for those formats
+    name = os.path.basename(filename)
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0] + "_modified" + FORMATS[output_format]
+
+@contextmanager
+def transform_resources(usps_client=None, address_cache=None, workers=1, record_store=None, checkpoint=None,
+                        usps_processes=1):
+    # the USPS client, address cache, process pool and record store for one
+    # run; anything created here rather than passed in is closed again
+    # afterwards. address_cache=False or record_store=False turns those off.
+    # a USPS client made here gets its share of the USPS limits for
+    # usps_processes runs at once.
+    # the run's checkpoint, if any, is let go at the end, whether or not the
+    # run finished, so another run can resume it
+    client = usps_client or make_usps_client(processes=usps_processes)
+    cache = make_address_cache() if address_cache is None else address_cache
+    store = make_record_store() if record_store is None else record_store
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        yield client, cache or None, pool, store or None
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if usps_client is None:
+            client.close()
+        if address_cache is None and cache is not None:
+            cache.close()
+        if record_store is None and store is not None:
+            store.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+def modify_csv(file_path, usps_client=None, address_cache=None, chunksize=None, progress=None, workers=None,
+               output_format=None, record_store=None, output_dir=None, checkpoint=None, usps_processes=1):
+    # progress, if given, is called as progress(stage, rows_processed) while
+    # the file is worked through: as each stage starts and, at most once
+    # every PROGRESS_SECONDS, as USPS answers during validation.
+    # usps_processes is the number of runs sharing the USPS limits, when no
+    # usps_client is given.
+    # the export goes to output_dir, by default an exports directory beside
+    # the upload's directory.
+    # progress is checkpointed (CHECKPOINT_DIR in config.py) so running the
+    # same upload again after a crash picks up where it stopped;
+    # checkpoint=False turns that off for this run.
+    # output_format is "csv", "parquet" or "feather" (OUTPUT_FORMAT in
+    # config.py, default csv); the input may be any of them too.
+    # record_store (RECORD_STORE_PATH in config.py) keeps the export rows of
+    # earlier runs so only new and changed rows are transformed again.
+    # workers > 1 spreads the name and address checks over that many processes.
+    # per-stage timings are logged and written next to the export as
+    # <name>_modified.stages.json
+    if output_format is None:
+        output_format = getattr(config, "OUTPUT_FORMAT", "csv")
+    check_format(output_format)
+
+    # Generate the new file name
+    exports_dir = output_dir or os.path.join(os.path.dirname(file_path), "../exports")
+    os.makedirs(exports_dir, exist_ok=True)
+    modified_file_path = os.path.join(exports_dir, export_name(file_path, output_format))
+
+    # rows per chunk; set CHUNK_ROWS in config.py to bound memory on large files
+    if chunksize is None:
+        chunksize = getattr(config, "CHUNK_ROWS", None)
+    if workers is None:
+        workers = getattr(config, "TRANSFORM_WORKERS", 1)
+
+    rows_processed = 0
+    reported = 0.0
+
+    def report(stage):
+        nonlocal reported
+        if progress is not None:
+            progress(stage, rows_processed)
+            reported = time.monotonic()
+
+    def validating(rows_before):
+        # rows_processed as USPS answers for the rows after the first rows_before
+        def on_rows(rows):
+            nonlocal rows_processed
+            rows_processed = rows_before + rows
+            if time.monotonic() - reported >= PROGRESS_SECONDS:
+                report("validation")
+        return on_rows if progress is not None else None
+
+    metrics = StageMetrics(on_stage=report)
+    checkpoint = make_checkpoint(file_path, output_format) if checkpoint is None else checkpoint or None
+    duplicate_index = DuplicateIndex()
+    resources = transform_resources(usps_client, address_cache, workers, record_store, checkpoint, usps_processes)
+    with resources as (client, cache, pool, store):
+        if not chunksize:
+            # Load CSV data into a DataFrame and process it in one go
+            df = metrics.run("read", read_records, file_path)
+            rows_in = len(df)
+            df = process_records(df, client, cache, metrics=metrics, pool=pool, workers=workers,
+                                 record_store=store, checkpoint=checkpoint, progress=validating(0))
+            rows_processed = rows_in
+            df = metrics.run("dedupe", flag_duplicates, df, duplicate_index)
+            df = metrics.run("sort", sort_records, df)
+            metrics.run("write", write_records, df, modified_file_path, output_format=output_format)
+        else:
+            # process the file a chunk at a time, writing each chunk as a
+            # sorted run, then merge the runs into the export
+            with tempfile.TemporaryDirectory(dir=exports_dir) as tmp_dir:
+                run_paths = []
+                chunks = read_records(file_path, chunksize=chunksize)
+                while True:
+                    chunk = metrics.run("read", next, chunks, None)
+                    if chunk is None:
+                        break
+                    rows_before, rows_in = rows_processed, len(chunk)
+                    df = process_records(chunk, client, cache, metrics=metrics, pool=pool, workers=workers,
+                                         record_store=store, checkpoint=checkpoint,
+                                         progress=validating(rows_before))
+                    df = metrics.run("dedupe", flag_duplicates, df, duplicate_index)
+                    df = metrics.run("sort", sort_records, df)
+                    rows_processed = rows_before + rows_in
+                    run_path = os.path.join(tmp_dir, f"run_{len(run_paths)}.csv")
+                    metrics.run("write", write_records, df, run_path)
+                    run_paths.append(run_path)
+                    del df
+
+                if not run_paths:
+                    write_records(pd.DataFrame(columns=OUTPUT_COLUMNS), modified_file_path, output_format=output_format)
+                elif output_format == "csv":
+                    metrics.run("merge", merge_sorted_runs, run_paths, modified_file_path, tmp_dir)
+                else:
+                    # merge to CSV, then convert that a chunk at a time
+                    merged_path = os.path.join(tmp_dir, "merged.csv")
+                    metrics.run("merge", merge_sorted_runs, run_paths, merged_path, tmp_dir)
+                    metrics.run("convert", convert_export, merged_path, modified_file_path, output_format, chunksize)
+
+        # the export is written, so there is nothing left to resume
+        if checkpoint is not None:
+            checkpoint.remove()
+
+    metrics.write(file_path, modified_file_path)
+    return modified_file_path
+
+#%%
+def stream_csv(source, usps_client=None, address_cache=None, chunksize=None, workers=None, metrics=None,
+               name="stream", record_store=None, usps_processes=1):
+    # transform records as they are read from source (a path or a binary file
+    # object, plain or gzip) and yield the export as CSV text a chunk at a
+    # time, so nothing is staged on disk and memory is bounded by the chunk
+    # size. The whole file is never in hand, so rows are sorted within each
+    # chunk rather than across the file.
+    # the first chunk is yielded with the header once it has been processed,
+    # so unreadable input fails before anything is sent.
+    # usps_processes is as for modify_csv
+    if not chunksize:
+        chunksize = getattr(config, "CHUNK_ROWS", None) or STREAM_CHUNK_ROWS
+    if workers is None:
+        workers = getattr(config, "TRANSFORM_WORKERS", 1)
+    metrics = metrics or StageMetrics()
+    duplicate_index = DuplicateIndex()
+
+    resources = transform_resources(usps_client, address_cache, workers, record_store, usps_processes=usps_processes)
+    with resources as (client, cache, pool, store):
+        chunks = read_records(source, chunksize=chunksize)
+        header = True
+        while True:
+            chunk = metrics.run("read", next, chunks, None)
+            if chunk is None:
+                break
+            if chunk.empty:
+                continue
+            df = process_records(chunk, client, cache, metrics=metrics, pool=pool, workers=workers,
+                                 record_store=store)
+            df = metrics.run("dedupe", flag_duplicates, df, duplicate_index)
+            df = metrics.run("sort", sort_records, df)
+            text = io.StringIO()
+            metrics.run("write", write_records, df, text, header=header)
+            yield text.getvalue()
+            header = False
+            del df
+
+        if header:
+            yield pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(index=False)
+
+    metrics.log(input=name, export=None)
+
+def gzip_chunks(chunks, level=6):
+    # gzip-compress an iterable of str or bytes chunks as they are produced
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
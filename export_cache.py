@@ -0,0 +1,150 @@
+#%%
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from record_store import TRANSFORM_VERSION
+
+#%%
+def save_upload(stream, uploads_dir, block_size=1 << 20):
+    # write an uploaded file under the SHA-256 of its content, hashing it as
+    # it is written; returns (path, digest). The same content uploaded again
+    # lands on the same file, and differently named uploads never collide
+    os.makedirs(uploads_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=uploads_dir, suffix=".tmp", delete=False) as f:
+        try:
+            for block in iter(lambda: stream.read(block_size), b""):
+                digest.update(block)
+                f.write(block)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    path = os.path.join(uploads_dir, digest.hexdigest())
+    os.replace(f.name, path)
+    return path, digest.hexdigest()
+
+
+def export_key(digest, output_format):
+    # an export can be reused for the same content, format and transform
+    return f"{digest}-v{TRANSFORM_VERSION}-{output_format}"
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+#%%
+class ExportCache:
+    """SQLite index of the job that produced each export, keyed by export_key.
+
+    Each entry names the job, the upload it read and the directory its
+    export was written to, and the size of that directory once the job has
+    ended. Past `max_entries` entries or `max_bytes` of exports the least
+    recently used are evicted, and their export directories deleted along
+    with uploads no other entry reads. `finished(job_id)` tells whether a
+    job is done or failed; entries of jobs still queued or running are never
+    evicted. Shared by the threads of the web process.
+    """
+
+    def __init__(self, path, max_entries=1000, max_bytes=10 * 2 ** 30, finished=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.finished = finished or (lambda job_id: True)
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS exports ("
+                          "key TEXT PRIMARY KEY, "
+                          "job_id TEXT NOT NULL, "
+                          "upload TEXT NOT NULL, "
+                          "export_dir TEXT NOT NULL, "
+                          "created REAL NOT NULL, "
+                          "accessed REAL NOT NULL, "
+                          "size INTEGER)")
+        # caches made before sizes were recorded; their sizes are measured
+        # by the next eviction
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(exports)")]
+        if "size" not in columns:
+            self.conn.execute("ALTER TABLE exports ADD COLUMN size INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS exports_accessed ON exports (accessed)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS exports_job ON exports (job_id)")
+        self.conn.commit()
+
+    def get(self, key):
+        """Return the job ID stored for key, or None."""
+        with self._lock:
+            row = self.conn.execute("SELECT job_id FROM exports WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE exports SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, job_id, upload, export_dir):
+        """Store the job that exports `upload` into `export_dir`, then apply eviction."""
+        now = time.time()
+        with self._lock:
+            replaced = self.conn.execute("SELECT export_dir FROM exports WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO exports (key, job_id, upload, export_dir, created, accessed) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (key, job_id, upload, export_dir, now, now))
+            self.conn.commit()
+            if replaced is not None and replaced[0] != export_dir:
+                shutil.rmtree(replaced[0], ignore_errors=True)
+            self.evict()
+
+    def record_size(self, job_id):
+        """Store the size of the export of a job that has ended, done or failed."""
+        with self._lock:
+            self._record_sizes(self.conn.execute("SELECT key, export_dir FROM exports WHERE job_id = ?",
+                                                 (job_id,)).fetchall())
+
+    def _record_sizes(self, rows):
+        self.conn.executemany("UPDATE exports SET size = ? WHERE key = ?",
+                              [(directory_size(export_dir), key) for key, export_dir in rows])
+        self.conn.commit()
+
+    def evict(self):
+        # jobs that ended without record_size being called (a restart, a
+        # worker that died) have their export measured once here
+        unsized = self.conn.execute("SELECT key, export_dir, job_id FROM exports WHERE size IS NULL").fetchall()
+        self._record_sizes([(key, export_dir) for key, export_dir, job_id in unsized if self.finished(job_id)])
+
+        # newest first, keeping entries until either limit is reached; the
+        # newest entry is always kept, whatever its size, and entries whose
+        # job hasn't ended (no size yet) are never evicted
+        evicted = self.conn.execute(
+            "SELECT key, upload, export_dir FROM ("
+            "SELECT key, upload, export_dir, size, "
+            "ROW_NUMBER() OVER newest AS position, SUM(COALESCE(size, 0)) OVER newest AS total "
+            "FROM exports WINDOW newest AS (ORDER BY accessed DESC ROWS UNBOUNDED PRECEDING)) "
+            "WHERE position > 1 AND size IS NOT NULL AND (position > ? OR total > ?)",
+            (self.max_entries, self.max_bytes)).fetchall()
+        if not evicted:
+            return
+
+        self.conn.executemany("DELETE FROM exports WHERE key = ?", [(key,) for key, _, _ in evicted])
+        self.conn.commit()
+        for key, upload, export_dir in evicted:
+            shutil.rmtree(export_dir, ignore_errors=True)
+            in_use = self.conn.execute("SELECT 1 FROM exports WHERE upload = ? LIMIT 1", (upload,)).fetchone()
+            if in_use is None and os.path.exists(upload):
+                os.remove(upload)
+
+    def close(self):
+        self.conn.close()
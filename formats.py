@@ -0,0 +1,147 @@
+#%%
+import pandas as pd
+
+from schema import AMOUNT_COLUMNS, COUNT_COLUMNS, DATE_COLUMNS, LENGTH_COLUMNS, from_text, to_text
+
+# pyarrow is only needed for Parquet and Feather; CSV works without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import feather, ipc
+except ImportError:
+    pa = None
+
+#%%
+# export formats and their file extensions
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+# first bytes of Parquet and Feather (Arrow IPC) files
+MAGIC = {b"PAR1": "parquet", b"ARROW1": "feather"}
+
+# columns stored with their own types in Parquet and Feather exports (the
+# gift fields and lengths, see schema.py); every other column, flags
+# included, is text. CSV exports are written as text throughout
+INTEGER_COLUMNS = list(COUNT_COLUMNS) + LENGTH_COLUMNS
+
+
+def available_formats():
+    return [name for name in FORMATS if name == "csv" or pa is not None]
+
+
+def check_format(output_format):
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown export format {output_format!r}, expected one of {', '.join(FORMATS)}")
+    if output_format not in available_formats():
+        raise ValueError(f"{output_format} exports need pyarrow installed")
+    return output_format
+
+
+def detect_format(path):
+    # "parquet" or "feather" for columnar files, None for anything else
+    with open(path, "rb") as f:
+        head = f.read(6)
+    for magic, name in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+#%%
+def arrow_type(column):
+    if column in AMOUNT_COLUMNS:
+        return pa.float64()
+    if column in DATE_COLUMNS:
+        # timestamps rather than dates, so a time of day given with a date is kept
+        return pa.timestamp("s")
+    if column in INTEGER_COLUMNS:
+        return pa.int64()
+    return pa.string()
+
+
+def typed_columns(df):
+    # an export frame, typed or read back as text, with the columns in the
+    # types they're stored as: numbers and dates typed, flags as "Y"/"N".
+    # dates are stored to the second, as CSV exports write them
+    df = to_text(from_text(df.copy()), flags_only=True)
+    for column in df.columns.intersection(DATE_COLUMNS):
+        df[column] = df[column].dt.floor("s")
+    return df
+
+
+def to_table(df):
+    schema = pa.schema([(column, arrow_type(column)) for column in df.columns])
+    return pa.Table.from_pandas(typed_columns(df), schema=schema, preserve_index=False)
+
+
+def write_columnar(df, path, output_format):
+    check_format(output_format)
+    if output_format == "parquet":
+        pq.write_table(to_table(df), path)
+    else:
+        feather.write_feather(to_table(df), path)
+
+
+def convert_export(csv_path, path, output_format, chunksize=100_000):
+    # rewrite a CSV export as Parquet or Feather a chunk at a time, so a file
+    # too big for memory can still be converted. Blanks stay blank text
+    check_format(output_format)
+    chunks = pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunksize)
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = to_table(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema) if output_format == "parquet" \
+                    else ipc.new_file(path, table.schema, options=ipc.IpcWriteOptions(compression="lz4"))
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+#%%
+def keeps_type(field):
+    # gift fields and lengths stored as numbers or dates are read as they are
+    if field.name in DATE_COLUMNS:
+        return pa.types.is_date(field.type) or (pa.types.is_timestamp(field.type) and field.type.tz is None)
+    if field.name in AMOUNT_COLUMNS or field.name in INTEGER_COLUMNS:
+        return pa.types.is_integer(field.type) or pa.types.is_floating(field.type) or pa.types.is_decimal(field.type)
+    return False
+
+
+def as_frame(table):
+    # an Arrow table as a DataFrame for the same stages as a CSV read with
+    # dtype=str: typed gift fields and lengths keep their types (parse_values
+    # only brings them to the types modify_csv works with), every other
+    # column is cast to text
+    schema = pa.schema([field if keeps_type(field) else pa.field(field.name, pa.string()) for field in table.schema])
+    df = table.cast(schema).to_pandas(date_as_object=False)
+    for column in df.columns.intersection(DATE_COLUMNS):
+        if df[column].dtype != object:
+            df[column] = df[column].astype("datetime64[ns]")
+    return df
+
+
+def read_columnar(path, chunksize=None):
+    # a Parquet or Feather file as a DataFrame, or an iterator of DataFrames
+    # of chunksize rows each (see as_frame)
+    output_format = check_format(detect_format(path))
+    if chunksize is None:
+        table = pq.read_table(path) if output_format == "parquet" else feather.read_table(path)
+        return as_frame(table)
+    return _read_columnar_chunks(path, output_format, chunksize)
+
+
+def _read_columnar_chunks(path, output_format, chunksize):
+    start = 0
+    if output_format == "parquet":
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunksize)
+    else:
+        batches = feather.read_table(path, memory_map=True).to_batches(max_chunksize=chunksize)
+    for batch in batches:
+        df = as_frame(pa.Table.from_batches([batch]))
+        # carry the row numbers on across chunks, as the CSV reader does
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
@@ -0,0 +1,215 @@
+#%%
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+#%%
+# job states written to the status file
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def status_path(jobs_dir, job_id):
+    return os.path.join(jobs_dir, f"{job_id}.json")
+
+
+def write_status(jobs_dir, job_id, **fields):
+    # merge fields into the job's status file; the file is replaced atomically
+    # so the web process never reads a half-written status
+    path = status_path(jobs_dir, job_id)
+    status = read_status(jobs_dir, job_id) or {"job_id": job_id}
+    status.update(fields, updated=time.time())
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+    return status
+
+
+def read_status(jobs_dir, job_id):
+    try:
+        with open(status_path(jobs_dir, job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+#%%
+def run_job(jobs_dir, job_id, file_path, options):
+    # runs in a worker process: transform one upload and record progress
+    # in the job's status file as it goes; options are passed to modify_csv
+    from csv_transformer import modify_csv
+    from metrics import read_stages
+
+    def progress(stage, rows_processed):
+        write_status(jobs_dir, job_id, state=RUNNING, stage=stage, rows_processed=rows_processed)
+
+    write_status(jobs_dir, job_id, state=RUNNING, stage="starting", started=time.time())
+    try:
+        export_path = modify_csv(file_path, progress=progress, **options)
+    except Exception as e:
+        traceback.print_exc()
+        write_status(jobs_dir, job_id, state=FAILED, error=f"{type(e).__name__}: {e}", finished=time.time())
+        return None
+
+    stages = read_stages(export_path)
+    write_status(jobs_dir, job_id, state=DONE, stage="done", export=os.path.abspath(export_path),
+                 finished=time.time(), stages=stages)
+    return stages
+
+
+#%%
+class JobQueue:
+    """Runs uploads through modify_csv in a local process pool.
+
+    Job status lives in one JSON file per job under `jobs_dir`, so any web
+    worker can answer status requests and the status survives a restart.
+    A job whose worker process dies is marked failed, and the pool is
+    started again for the next job.
+    """
+
+    def __init__(self, jobs_dir, max_workers=2, on_done=None, on_finished=None):
+        # on_done, if given, is called in this process with the stage
+        # summary of every job that finishes successfully; on_finished with
+        # the ID of every job submitted here once it is done or failed
+        self.jobs_dir = jobs_dir
+        self.max_workers = max_workers
+        self.on_done = on_done
+        self.on_finished = on_finished
+        self._executor = None
+        self._futures = {}  # job_id -> future of the jobs this process is running
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.fail_orphans()
+
+    @property
+    def executor(self):
+        # start the worker processes on first use rather than at import
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _discard_executor(self, executor):
+        # a pool whose worker died (killed for memory, os._exit) takes no more
+        # jobs; drop it so the next submit starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def fail_orphans(self):
+        # jobs left queued or running by a web process that is gone (a restart
+        # or a crash) will never finish; jobs of other live web workers sharing
+        # jobs_dir are left alone
+        for name in os.listdir(self.jobs_dir):
+            job_id, ext = os.path.splitext(name)
+            if ext != ".json" or not JOB_ID_PATTERN.fullmatch(job_id):
+                continue
+            status = read_status(self.jobs_dir, job_id)
+            if status is None or status.get("state") not in (QUEUED, RUNNING):
+                continue
+            if status.get("server") != os.getpid() and process_alive(status.get("server")):
+                continue
+            write_status(self.jobs_dir, job_id, state=FAILED, error="interrupted by a restart",
+                         finished=time.time())
+
+    def submit(self, file_path, filename=None, **options):
+        job_id = uuid.uuid4().hex
+        write_status(self.jobs_dir, job_id, state=QUEUED, stage="queued", rows_processed=0,
+                     filename=filename or os.path.basename(file_path), submitted=time.time(),
+                     server=os.getpid())
+        executor = self.executor
+        try:
+            future = executor.submit(run_job, self.jobs_dir, job_id, file_path, options)
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            executor = self.executor
+            future = executor.submit(run_job, self.jobs_dir, job_id, file_path, options)
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(lambda future: self._job_done(job_id, executor, future))
+        return job_id
+
+    def reuse(self, job_id, filename):
+        # a job for an upload whose export another job has made or is making:
+        # a finished job is copied under a new ID with this upload's file
+        # name, an unfinished one is shared while it is still running in this
+        # process. None if there's nothing to reuse
+        status = self.status(job_id)
+        if status is None or status["state"] == FAILED:
+            return None
+        if status["state"] != DONE:
+            with self._lock:
+                future = self._futures.get(job_id)
+            if future is not None and not future.done():
+                return job_id
+            # its worker or web process is gone (or it belongs to another web
+            # worker, whose progress this one can't vouch for)
+            if status.get("server") == os.getpid() or not process_alive(status.get("server")):
+                write_status(self.jobs_dir, job_id, state=FAILED, error="interrupted", finished=time.time())
+            return None
+        if not os.path.exists(status["export"]):
+            return None
+        new_id = uuid.uuid4().hex
+        fields = {key: value for key, value in status.items() if key not in ("job_id", "updated")}
+        fields.update(filename=filename, submitted=time.time(), reused=job_id)
+        write_status(self.jobs_dir, new_id, **fields)
+        return new_id
+
+    def _job_done(self, job_id, executor, future):
+        # run_job records its own failures; this catches the worker dying
+        # under it, which leaves the status queued or running
+        with self._lock:
+            self._futures.pop(job_id, None)
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._discard_executor(executor)
+            status = read_status(self.jobs_dir, job_id)
+            if status is not None and status["state"] in (QUEUED, RUNNING):
+                reason = "cancelled" if error is None else f"{type(error).__name__}: {error}"
+                write_status(self.jobs_dir, job_id, state=FAILED, error=reason, finished=time.time())
+        elif self.on_done is not None and future.result() is not None:
+            self.on_done(future.result())
+        if self.on_finished is not None:
+            self.on_finished(job_id)
+
+    def finished(self, job_id):
+        # whether a job is done or failed; one with no status is long gone
+        status = self.status(job_id)
+        return status is None or status["state"] in (DONE, FAILED)
+
+    def status(self, job_id):
+        # job IDs come from URLs; anything that isn't one of ours is unknown
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        return read_status(self.jobs_dir, job_id)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,136 @@
+#%%
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from schema import TEXT_DTYPE
+
+#%%
+# American Soundex digits; vowels (and Y) separate letters with the same
+# digit, H and W don't
+SOUNDEX_DIGITS = {**dict.fromkeys("BFPV", "1"), **dict.fromkeys("CGJKQSXZ", "2"), **dict.fromkeys("DT", "3"),
+                  "L": "4", **dict.fromkeys("MN", "5"), "R": "6", **dict.fromkeys("AEIOUY", "0")}
+
+NOT_LETTERS = re.compile(r"[\W\d_]+")
+
+
+def soundex(name):
+    # phonetic key of a name: "Smith", "Smyth" and "Smithe" are all S530;
+    # accents are dropped, and a name without letters has no key
+    letters = [c for c in unicodedata.normalize("NFKD", str(name)).upper() if "A" <= c <= "Z"]
+    if not letters:
+        return ""
+    key, last = letters[0], SOUNDEX_DIGITS.get(letters[0])
+    for c in letters[1:]:
+        digit = SOUNDEX_DIGITS.get(c)
+        if digit is None:
+            continue
+        if digit != "0" and digit != last:
+            key += digit
+        last = digit
+    return (key + "000")[:4]
+
+
+def map_unique(values, func):
+    # func applied once per distinct value; names repeat a lot
+    unique = pd.unique(values)
+    return values.map(dict(zip(unique, map(func, unique))))
+
+
+def names_in_text(names, texts):
+    # whether each name of more than one character is part of the text beside
+    # it; both are expected in the same case
+    return pd.Series([len(name) > 1 and name in text for name, text in zip(names, texts)],
+                     index=names.index, dtype=bool)
+
+#%%
+def letters_only(name):
+    return NOT_LETTERS.sub("", name).upper()
+
+
+def normalize_text(values):
+    # ignore case, repeated spaces and trailing periods, as normalize_address does
+    return values.str.replace(r"\s+", " ", regex=True).str.strip().str.rstrip(".").str.upper()
+
+
+def match_keys(df):
+    # the key two records of one person share: the ZIP5 and street of their
+    # address, the Soundex of their last name, and their first name and
+    # suffix as letters only, one column each. The USPS street and ZIP are
+    # used where there are any. Returns the keys and a mask of the records
+    # that have one: those with a first name, last name and ZIP.
+    # names repeat, so they are worked out once per distinct value; addresses
+    # mostly don't, and are normalized as compact text
+    street = df["V_STREET"].where(df["V_STREET"] != "", df["ADDRESS1"])
+    keys = pd.DataFrame({"zip5": df["V_ZIP5"].where(df["V_ZIP5"] != "", df["ZIP_POSTALCODE"].str[:5]),
+                         "last": map_unique(df["LASTNAME"], soundex),
+                         "first": map_unique(df["FIRSTNAME"], letters_only),
+                         "suffix": map_unique(df["SUFFIX"], letters_only),
+                         "street": normalize_text(street.astype(TEXT_DTYPE)),
+                         "unit": normalize_text(df["ADDRESS2"].astype(TEXT_DTYPE))}, index=df.index).astype(object)
+    keyed = (keys["zip5"] != "") & (keys["last"] != "") & (keys["first"] != "")
+    return keys, keyed.to_numpy(dtype=bool)
+
+
+def hash_rows(values):
+    # a 64-bit hash of each row of a frame (or each value of a Series); only
+    # comparable within one process
+    rows = zip(*(values[column] for column in values.columns)) if isinstance(values, pd.DataFrame) else values
+    return np.fromiter(map(hash, rows), dtype=np.int64, count=len(values))
+
+
+class DuplicateIndex:
+    """Records seen so far, by the hash of their match_keys, for spotting the
+    same person under more than one ROI_FAMILY_ID.
+
+    Holds the ROI_FAMILY_ID (hashed) of the first record seen with each key
+    as two sorted arrays, so it stays small and each frame is matched against
+    it in one pass however many frames went before. A record is a possible
+    duplicate when an earlier record with its key has another ROI_FAMILY_ID;
+    the first record of each person is never flagged, so a file gives the same
+    flags whether it is read whole or a chunk at a time. Hashes are only
+    comparable within a process, so an index is used by the process that
+    built it.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.owners = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        # owner of each key, and whether the key was there at all
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        position = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        return self.owners[position], self.keys[position] == keys
+
+    def add(self, keys, owners):
+        # sorted keys, none of them in the index yet
+        position = np.searchsorted(self.keys, keys)
+        self.keys = np.insert(self.keys, position, keys)
+        self.owners = np.insert(self.owners, position, owners)
+
+    def flag(self, df):
+        """Return a boolean Series marking the possible duplicates of df, in
+        row order, and add its records to the index."""
+        flags = np.zeros(len(df), dtype=bool)
+        keys, keyed = match_keys(df)
+        if not keyed.any():
+            return pd.Series(flags, index=df.index)
+        hashes = hash_rows(keys[keyed])
+        families = hash_rows(df["ROI_FAMILY_ID"][keyed].astype(object))
+
+        # the first family of each key within df, then those seen in earlier frames
+        first = pd.Series(families).groupby(hashes, sort=True).first()
+        unique, owners = first.index.to_numpy(dtype=np.int64), first.to_numpy(dtype=np.int64)
+        earlier, found = self.lookup(unique)
+        owners = np.where(found, earlier, owners)
+        self.add(unique[~found], owners[~found])
+
+        flags[keyed] = families != owners[np.searchsorted(unique, hashes)]
+        return pd.Series(flags, index=df.index)
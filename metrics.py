@@ -0,0 +1,160 @@
+#%%
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("csv_transformer")
+
+#%%
+def current_rss():
+    # resident set size of this process in bytes, or None where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageMetrics:
+    """Wall time, CPU time, rows in/out and memory change for each stage of a run.
+
+    A stage that runs more than once (once per chunk in chunked mode) is
+    accumulated under its name. `on_stage` is called with the stage name each
+    time one starts.
+    """
+
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def run(self, name, function, *args, **kwargs):
+        # call function(*args, **kwargs) as stage `name`; rows in is the length
+        # of the first argument and rows out the length of the result (or the
+        # result itself when the stage returns a row count)
+        if self.on_stage is not None:
+            self.on_stage(name)
+
+        rss_before = current_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = function(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        rss_after = current_rss()
+
+        stage = self.stages.setdefault(name, {"stage": name, "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                              "rows_in": 0, "rows_out": 0, "memory_delta_mb": 0.0})
+        stage["calls"] += 1
+        stage["wall_seconds"] += wall
+        stage["cpu_seconds"] += cpu
+        stage["rows_in"] += _rows(args[0]) if args else 0
+        stage["rows_out"] += _rows(result)
+        if rss_before is not None and rss_after is not None:
+            stage["memory_delta_mb"] += (rss_after - rss_before) / 2 ** 20
+        return result
+
+    def summary(self):
+        return {"total_seconds": time.perf_counter() - self.started,
+                "peak_rss_mb": _peak_rss_mb(),
+                "stages": [dict(stage) for stage in self.stages.values()]}
+
+    def log(self, **fields):
+        # one structured log line per run, with fields naming the input and export
+        summary = dict(self.summary(), **fields)
+        logger.info(json.dumps({"event": "modify_csv", **summary}))
+        return summary
+
+    def write(self, file_path, export_path):
+        # the log line plus a JSON sidecar next to the export
+        summary = self.log(input=os.path.basename(file_path), export=os.path.basename(export_path))
+
+        with open(stages_path(export_path), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def stages_path(export_path):
+    # the JSON sidecar written next to an export
+    return os.path.splitext(export_path)[0] + ".stages.json"
+
+
+def read_stages(export_path):
+    with open(stages_path(export_path)) as f:
+        return json.load(f)
+
+
+def _rows(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / 2 ** 20 if os.uname().sysname == "Darwin" else peak / 2 ** 10
+
+
+#%%
+# histogram buckets for stage wall time, in seconds
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+
+class StageHistograms:
+    """Aggregates stage timings from finished runs for the /metrics endpoint.
+
+    Rendered in the Prometheus text format so it can be scraped as-is.
+    """
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = list(buckets)
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._runs = {"count": 0, "sum": 0.0}
+
+    def observe(self, summary):
+        with self._lock:
+            self._runs["count"] += 1
+            self._runs["sum"] += summary["total_seconds"]
+            for stage in summary["stages"]:
+                histogram = self._stages.setdefault(stage["stage"], {"buckets": [0] * len(self.buckets),
+                                                                     "count": 0, "sum": 0.0, "rows": 0})
+                seconds = stage["wall_seconds"]
+                position = bisect.bisect_left(self.buckets, seconds)
+                for i in range(position, len(self.buckets)):
+                    histogram["buckets"][i] += 1
+                histogram["count"] += 1
+                histogram["sum"] += seconds
+                histogram["rows"] += stage["rows_in"]
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP csv_transform_runs_total Completed modify_csv runs",
+                     "# TYPE csv_transform_runs_total counter",
+                     f"csv_transform_runs_total {self._runs['count']}",
+                     "# HELP csv_transform_run_seconds_sum Total wall time of completed runs",
+                     "# TYPE csv_transform_run_seconds_sum counter",
+                     f"csv_transform_run_seconds_sum {self._runs['sum']:.6f}",
+                     "# HELP csv_transform_stage_seconds Wall time per modify_csv stage",
+                     "# TYPE csv_transform_stage_seconds histogram"]
+            for name, histogram in self._stages.items():
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'csv_transform_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'csv_transform_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'csv_transform_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]:.6f}')
+                lines.append(f'csv_transform_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+
+            lines += ["# HELP csv_transform_stage_rows_total Rows fed into each modify_csv stage",
+                      "# TYPE csv_transform_stage_rows_total counter"]
+            for name, histogram in self._stages.items():
+                lines.append(f'csv_transform_stage_rows_total{{stage="{name}"}} {histogram["rows"]}')
+        return "\n".join(lines) + "\n"
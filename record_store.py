@@ -0,0 +1,119 @@
+#%%
+import json
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+#%%
+# bump whenever a change to the transform would give a different export row
+# for the same input row, so results stored by older versions aren't reused
+TRANSFORM_VERSION = 5
+
+# columns that identify a donor record from one export to the next
+KEY_COLUMNS = ["ROI_ID", "ROI_FAMILY_ID"]
+
+
+def record_keys(df):
+    # "ROI_ID|ROI_FAMILY_ID" for every row, or None where either is missing
+    return [None if any(pd.isna(value) for value in ids) else "|".join(map(str, ids))
+            for ids in zip(*(df[column] for column in KEY_COLUMNS))]
+
+
+def fingerprints(df):
+    # a 64 bit hash of every column of each row, as signed integers for SQLite
+    return pd.util.hash_pandas_object(df, index=False).astype("int64").tolist()
+
+
+#%%
+class RecordStore:
+    """On-disk store of the export rows of earlier runs, keyed on ROI_ID/ROI_FAMILY_ID.
+
+    Each entry holds a fingerprint of the input row and the export row it
+    produced (or nothing, if the row was filtered out), so an input row with
+    the same fingerprint can skip the transform. Entries are only reused by
+    the same TRANSFORM_VERSION and input columns, for at most `ttl` seconds
+    so addresses are validated again now and then. Past `max_entries` the
+    least recently used are evicted.
+    """
+
+    def __init__(self, path, ttl=90 * 24 * 3600, max_entries=5_000_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.schema = None
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                          "key TEXT PRIMARY KEY, "
+                          "fingerprint INTEGER NOT NULL, "
+                          "output TEXT, "
+                          "created REAL NOT NULL, "
+                          "accessed REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS records_accessed ON records (accessed)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def use_schema(self, input_columns, output_columns):
+        """Empty the store if it was written for other columns or another TRANSFORM_VERSION."""
+        schema = json.dumps({"version": TRANSFORM_VERSION, "input": list(input_columns),
+                             "output": list(output_columns)})
+        if schema == self.schema:
+            return
+        stored = self.conn.execute("SELECT value FROM meta WHERE name = 'schema'").fetchone()
+        if stored is None or stored[0] != schema:
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('schema', ?)", (schema,))
+            self.conn.commit()
+        self.schema = schema
+
+    def get_many(self, keys):
+        """Return {key: (fingerprint, output row or None)} for every key with a live entry."""
+        now = time.time()
+        found = {}
+        keys = list(keys)
+
+        # stay under SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(f"SELECT key, fingerprint, output FROM records "
+                                     f"WHERE key IN ({placeholders}) AND created >= ?",
+                                     chunk + [now - self.ttl])
+            for key, fingerprint, output in rows:
+                found[key] = (fingerprint, json.loads(output) if output is not None else None)
+
+        if found:
+            self.conn.executemany("UPDATE records SET accessed = ? WHERE key = ?",
+                                  [(now, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def put_many(self, items):
+        """Store an iterable of (key, fingerprint, output row or None) and apply TTL/size eviction."""
+        now = time.time()
+        rows = [(key, fingerprint, json.dumps(output) if output is not None else None, now, now)
+                for key, fingerprint, output in items]
+        if not rows:
+            return
+
+        self.conn.executemany("INSERT OR REPLACE INTO records (key, fingerprint, output, created, accessed) "
+                              "VALUES (?, ?, ?, ?, ?)", rows)
+        self.evict(now)
+        self.conn.commit()
+
+    def evict(self, now=None):
+        now = now or time.time()
+        self.conn.execute("DELETE FROM records WHERE created < ?", (now - self.ttl,))
+
+        count = self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM records WHERE key IN ("
+                              "SELECT key FROM records ORDER BY accessed LIMIT ?)",
+                              (count - self.max_entries,))
+
+    def close(self):
+        self.conn.close()
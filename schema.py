@@ -0,0 +1,215 @@
+#%%
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from metrics import logger
+
+# Arrow-backed strings take a fraction of the memory of Python str objects;
+# without pyarrow text stays as objects
+try:
+    import pyarrow
+    TEXT_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:
+    TEXT_DTYPE = object
+
+#%%
+STRUCTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "validate", "qtool_structure.csv")
+
+
+def read_structure():
+    # column names of a qtool export
+    with open(STRUCTURE_FILE, encoding="utf-8-sig") as f:
+        return next(csv.reader(f))
+
+
+QTOOL_COLUMNS = read_structure()
+
+# gift fields, parsed into numbers and dates once whitespace is stripped
+AMOUNT_COLUMNS = ['LARGESTGIFT', 'TOTALGIFTAMOUNT', 'LASTGIFTAMOUNT', 'FIRSTGIFTAMOUNT']
+DATE_COLUMNS = ['LARGESTGIFTDATE', 'LASTGIFTDATE', 'FIRSTGIFTDATE']
+COUNT_COLUMNS = {'AGE': 'UInt16', 'TOTALGIFTCOUNT': 'UInt32'}
+
+# the input text of gift fields that couldn't be parsed, as a JSON object
+# by column name ('' when everything parsed), so nothing uploaded is lost
+UNPARSED_COLUMN = 'UNPARSED_VALUES'
+
+# currency symbols and thousands separators, dropped before numbers are read:
+# "$1,000.00" is 1000 and "1,500" is 1500
+NUMBER_NOISE = r'[$\u00a3\u20ac]|(?<=\d),(?=\d{3}(?!\d))'
+
+# columns modify_csv adds: name lengths, and flags that are booleans until
+# the export is written as "Y"/"N"
+LENGTH_COLUMNS = ['FIRSTNAME_LEN', 'MIDDLE_LEN', 'LASTNAME_LEN',
+                  'SPOUSE_FIRSTNAME_LEN', 'SPOUSE_MIDDLE_LEN', 'SPOUSELASTNAME_LEN']
+LENGTH_DTYPE = 'uint16'
+FLAG_COLUMNS = ['REVIEW', 'TRANSFORMED', 'CHECK_EMAIL', 'PREFIX_SUSPECT', 'SUFFIX_SUSPECT', 'HAD_AND',
+                'POSSIBLE_DUPLICATE']
+
+# text the name and address stages rewrite with Python string code: these
+# stay str objects until the export rows are finished, every other text
+# column is compact from the moment it is read
+WORKING_COLUMNS = ['PREFIX', 'FIRSTNAME', 'MIDDLENAME_INITIAL', 'LASTNAME', 'SUFFIX',
+                   'SPOUSEPREFIX', 'SPOUSEFIRSTNAME', 'SPOUSEMIDDLENAME_INITIAL', 'SPOUSELASTNAME', 'SPOUSESUFFIX',
+                   'EMAIL', 'ADDRESS1', 'ADDRESS2', 'CITY', 'STATE_PROVINCE', 'ZIP_POSTALCODE', 'COUNTRY']
+
+
+def is_text(column, dtype):
+    return column not in FLAG_COLUMNS and column not in LENGTH_COLUMNS and (dtype == object or dtype == TEXT_DTYPE)
+
+
+def read_dtypes():
+    # read_csv dtypes: compact text for qtool columns nobody rewrites, str for
+    # the rest (gift fields are parsed after whitespace is stripped)
+    typed = set(WORKING_COLUMNS) | set(AMOUNT_COLUMNS) | set(DATE_COLUMNS) | set(COUNT_COLUMNS)
+    return {column: str if column in typed else TEXT_DTYPE for column in QTOOL_COLUMNS}
+
+
+def compact_text(df, columns=None):
+    # text columns (all of them, or those given) as TEXT_DTYPE
+    if TEXT_DTYPE is object:
+        return df
+    for column in df.columns if columns is None else columns:
+        if column in df.columns and df[column].dtype == object and is_text(column, object):
+            df[column] = df[column].astype(TEXT_DTYPE)
+    return df
+
+
+def read_types(df):
+    # the types read_records gives a qtool column, for frames that were read
+    # some other way (Parquet/Feather input)
+    return compact_text(df, [column for column, dtype in read_dtypes().items() if dtype is TEXT_DTYPE])
+
+#%%
+def _unparsed(column, text, values):
+    # the positions and text of values that were there in the input but
+    # couldn't be parsed
+    unparsed = (values.isna() & text.notna() & (text != '')).to_numpy()
+    if unparsed.any():
+        logger.warning(json.dumps({"event": "unparsed_values", "column": column, "rows": int(unparsed.sum())}))
+    return np.flatnonzero(unparsed), text[unparsed].tolist()
+
+
+def keep_unparsed(df, unparsed):
+    # add the text of each column that didn't parse to the rows' UNPARSED_VALUES
+    column = df[UNPARSED_COLUMN].astype(object).to_numpy(copy=True) if UNPARSED_COLUMN in df.columns \
+        else np.full(len(df), '', dtype=object)
+    found = {}
+    for name, (positions, texts) in unparsed.items():
+        for position, value in zip(positions, texts):
+            found.setdefault(position, {})[name] = value
+    for position, values in found.items():
+        earlier = column[position]
+        column[position] = json.dumps({**(json.loads(earlier) if earlier else {}), **values})
+    df[UNPARSED_COLUMN] = column
+    return df
+
+
+def strip_number_noise(text):
+    # values that aren't strings (numbers from stored rows or columnar input)
+    # are kept as they are
+    if pd.api.types.is_numeric_dtype(text.dtype):
+        return text
+    return text.astype(object).str.replace(NUMBER_NOISE, '', regex=True).fillna(text)
+
+
+def parse_amounts(text):
+    return pd.to_numeric(strip_number_noise(text), errors='coerce').astype('float64')
+
+
+def parse_dates(text):
+    dates = pd.to_datetime(text, errors='coerce')
+    # the format is inferred from the first date; retry any others one by one
+    retry = dates.isna() & text.notna() & (text != '')
+    if retry.any():
+        dates[retry] = pd.to_datetime(text[retry], errors='coerce', format='mixed')
+    return dates
+
+
+def parse_counts(text, dtype):
+    numbers = pd.to_numeric(strip_number_noise(text), errors='coerce')
+    # whole numbers that fit the column's type; anything else is left unparsed
+    info = np.iinfo(pd.api.types.pandas_dtype(dtype).numpy_dtype)
+    numbers = numbers.where((numbers % 1 == 0) & (numbers >= info.min) & (numbers <= info.max))
+    return numbers.astype(dtype)
+
+
+def parsed_dtype(column):
+    if column in AMOUNT_COLUMNS:
+        return np.dtype('float64')
+    if column in DATE_COLUMNS:
+        return np.dtype('datetime64[ns]')
+    return pd.api.types.pandas_dtype(COUNT_COLUMNS[column])
+
+
+def parse_values(df):
+    # gift amounts, dates and counts from text to their own types; text that
+    # doesn't parse is blank in its column and kept in UNPARSED_VALUES.
+    # Columns read from Parquet or Feather may already be numbers or dates;
+    # those are brought to the same types
+    unparsed = {}
+    for column in df.columns.intersection(AMOUNT_COLUMNS + DATE_COLUMNS + list(COUNT_COLUMNS)):
+        if df[column].dtype == parsed_dtype(column):
+            continue
+        text = df[column]
+        if column in AMOUNT_COLUMNS:
+            df[column] = parse_amounts(text)
+        elif column in DATE_COLUMNS:
+            df[column] = parse_dates(text)
+        else:
+            df[column] = parse_counts(text, COUNT_COLUMNS[column])
+        unparsed[column] = _unparsed(column, text, df[column])
+    return keep_unparsed(df, unparsed)
+
+
+def from_text(df):
+    # an export frame read back as text (a CSV export, stored rows) in the
+    # types modify_csv works with
+    df = parse_values(df)
+    for column in df.columns.intersection(FLAG_COLUMNS):
+        if df[column].dtype == object:
+            df[column] = df[column] == 'Y'
+    for column in df.columns.intersection(LENGTH_COLUMNS):
+        df[column] = pd.to_numeric(df[column]).astype(LENGTH_DTYPE)
+    return compact_text(df)
+
+#%%
+def format_amounts(values):
+    # shortest text that reads back as the same number, without a trailing ".0"
+    return values.map(lambda value: np.format_float_positional(value, trim='-'), na_action='ignore')
+
+
+def format_dates(values):
+    # YYYY-MM-DD, or YYYY-MM-DD HH:MM:SS for a date given with a time of day
+    text = values.dt.strftime('%Y-%m-%d')
+    timed = values.notna() & (values != values.dt.normalize())
+    if not timed.any():
+        return text
+    return text.where(~timed, values.dt.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def to_text(df, flags_only=False):
+    # the export's text form: flags as "Y"/"N", dates as YYYY-MM-DD (with
+    # the time if there is one) and amounts without trailing zeros; with
+    # flags_only the gift fields keep their types (for the columnar formats)
+    df = df.copy()
+    for column in df.columns.intersection(FLAG_COLUMNS):
+        if df[column].dtype == bool:
+            df[column] = np.where(df[column], 'Y', 'N')
+    if flags_only:
+        return df
+    for column in df.columns.intersection(AMOUNT_COLUMNS):
+        if df[column].dtype != object:
+            df[column] = format_amounts(df[column])
+    for column in df.columns.intersection(DATE_COLUMNS):
+        if df[column].dtype != object:
+            df[column] = format_dates(df[column])
+    return df
+
+
+def frame_memory_mb(df):
+    # memory held by a frame, counting the strings themselves
+    return df.memory_usage(index=True, deep=True).sum() / 2 ** 20
@@ -0,0 +1,70 @@
+# make the repo importable and fall back to a placeholder config when there
+# is no config.py, as benchmarks/common.py does; no test talks to USPS (the
+# client tests use the local stub in benchmarks/usps_stub.py)
+import os
+import sys
+import types
+
+import pandas as pd
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+# the benchmark scripts import their helpers as top-level modules
+sys.path.insert(1, os.path.join(REPO_DIR, "benchmarks"))
+
+try:
+    import config
+except ImportError:
+    config = types.ModuleType("config")
+    config.USPS_API_KEY = "TEST"
+    sys.modules["config"] = config
+
+from benchmarks.generate_exports import generate
+from benchmarks.usps_stub import verify_response
+from usps import VerifyClient
+
+#%%
+class FakeUSPS(VerifyClient):
+    """Answers in process as the USPS stub would, one batch at a time.
+
+    Requests are built and parsed as for the real clients. After
+    `fail_after` batches every further call raises, as a run does when its
+    process dies mid-validation.
+    """
+
+    def __init__(self, fail_after=None):
+        super().__init__("TEST")
+        self.fail_after = fail_after
+        self.batches_sent = 0
+        self.addresses_sent = 0
+
+    def validate(self, addresses, on_results=None):
+        results = []
+        for batch in self.batches(addresses):
+            if self.fail_after is not None and self.batches_sent >= self.fail_after:
+                raise ConnectionError("USPS went away")
+            answer = self.parse_response(verify_response(self.build_request(batch)), batch)
+            self.batches_sent += 1
+            self.addresses_sent += len(batch)
+            if on_results is not None:
+                on_results(len(results), answer)
+            results += answer
+        return results
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope="session")
+def donors(tmp_path_factory):
+    # a generated upload in which every 40th donor is listed again at the end
+    # under a new ROI_FAMILY_ID, so some possible duplicates are far apart
+    path = str(tmp_path_factory.mktemp("uploads") / "donors.csv")
+    generate(path, 2000, seed=7)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False, encoding="ISO-8859-1")
+    copies = df.iloc[::40].copy()
+    copies["ROI_ID"] = "9" + copies["ROI_ID"]
+    copies["ROI_FAMILY_ID"] = "9" + copies["ROI_FAMILY_ID"]
+    pd.concat([df, copies]).to_csv(path, index=False, encoding="ISO-8859-1")
+    return path
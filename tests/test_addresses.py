@@ -0,0 +1,86 @@
+"""check_addresses on small frames, one kind of address per row."""
+#%%
+import pandas as pd
+
+from csv_transformer import check_addresses
+
+#%%
+COMPLETE = {"ADDRESS1": "12 Main St", "ADDRESS2": "", "CITY": "Springfield", "STATE_PROVINCE": "IL",
+            "ZIP_POSTALCODE": "62701", "COUNTRY": "US"}
+BLANK = {"ADDRESS1": "", "ADDRESS2": "", "CITY": "", "STATE_PROVINCE": "", "ZIP_POSTALCODE": "", "COUNTRY": "US"}
+
+
+def addresses(**rows):
+    # a frame of the address columns, one row per keyword, labelled by it
+    return pd.DataFrame.from_dict(rows, orient="index", dtype=object)
+
+
+def check(**rows):
+    return check_addresses(addresses(**rows))
+
+
+def changed(base, **fields):
+    return {**base, **fields}
+
+#%%
+def test_blank_addresses_are_dropped():
+    df = check(blank=BLANK, complete=COMPLETE)
+    assert df.index.tolist() == ["complete"]
+    assert "ADDRESS_BLANK" not in df.columns
+
+
+def test_whitespace_and_periods_alone_are_blank():
+    df = check(blank=changed(BLANK, ADDRESS1="  .", ADDRESS2=" ", CITY=" "), complete=COMPLETE)
+    assert df.index.tolist() == ["complete"]
+
+
+def test_only_us_addresses_outside_the_territories_are_kept():
+    df = check(canada=changed(COMPLETE, COUNTRY="CA", STATE_PROVINCE="ON"),
+               puerto_rico=changed(COMPLETE, STATE_PROVINCE="PR"), guam=changed(COMPLETE, STATE_PROVINCE="GU"),
+               complete=COMPLETE)
+    assert df.index.tolist() == ["complete"]
+
+
+def test_bad_or_blank_state_is_invalid_and_incomplete():
+    df = check(bad=changed(COMPLETE, STATE_PROVINCE="XX"), blank=changed(COMPLETE, STATE_PROVINCE=""),
+               name=changed(COMPLETE, STATE_PROVINCE="Illinois"), lower=changed(COMPLETE, STATE_PROVINCE="il"))
+    assert df["STATE_INVALID"].to_dict() == {"bad": True, "blank": True, "name": True, "lower": False}
+    assert df["ADDRESS_INCOMPLETE"].to_dict() == {"bad": True, "blank": True, "name": True, "lower": False}
+    assert df.loc[["bad", "blank", "name"], "FULL_ADDRESS"].eq("").all()
+
+
+def test_valid_state_missing_street_or_zip_is_incomplete():
+    df = check(no_street=changed(COMPLETE, ADDRESS1=""), no_zip=changed(COMPLETE, ZIP_POSTALCODE=" "),
+               no_city=changed(COMPLETE, CITY=""), complete=COMPLETE)
+    assert df["ADDRESS_INCOMPLETE"].to_dict() == {"no_street": True, "no_zip": True, "no_city": False,
+                                                  "complete": False}
+    assert not df["STATE_INVALID"].any()
+    assert df.loc[["no_street", "no_zip"], "FULL_ADDRESS"].eq("").all()
+
+
+def test_full_address_joins_the_parts_that_are_there():
+    df = check(complete=COMPLETE, unit=changed(COMPLETE, ADDRESS2="Apt 4"), no_city=changed(COMPLETE, CITY=""),
+               spaced=changed(COMPLETE, ADDRESS1=" 12 Main St ", STATE_PROVINCE=" il "))
+    assert df["FULL_ADDRESS"].to_dict() == {
+        "complete": "12 Main St, Springfield, IL, 62701",
+        "unit": "12 Main St, Apt 4, Springfield, IL, 62701",
+        "no_city": "12 Main St, IL, 62701",
+        "spaced": "12 Main St, Springfield, IL, 62701",
+    }
+
+
+def test_trailing_periods_are_trimmed_on_complete_addresses_only():
+    df = check(complete=changed(COMPLETE, ADDRESS1="12 Main St.", ADDRESS2="Apt 4."),
+               incomplete=changed(COMPLETE, ADDRESS1="12 Main St.", ADDRESS2="Apt 4.", ZIP_POSTALCODE=""),
+               invalid=changed(COMPLETE, ADDRESS1="12 Main St.", STATE_PROVINCE="XX"))
+    assert df.loc["complete", ["ADDRESS1", "ADDRESS2"]].tolist() == ["12 Main St", "Apt 4"]
+    assert df.loc["complete", "FULL_ADDRESS"] == "12 Main St, Apt 4, Springfield, IL, 62701"
+    assert df.loc["incomplete", ["ADDRESS1", "ADDRESS2"]].tolist() == ["12 Main St.", "Apt 4."]
+    assert df.loc["invalid", "ADDRESS1"] == "12 Main St."
+
+
+def test_hash_becomes_unit():
+    df = check(spaced=changed(COMPLETE, ADDRESS2="# 4"), joined=changed(COMPLETE, ADDRESS2="#4B"),
+               apartment=changed(COMPLETE, ADDRESS2="Apt 4"))
+    assert df["ADDRESS2"].to_dict() == {"spaced": "Unit 4", "joined": "Unit 4B", "apartment": "Apt 4"}
+    assert df.loc["joined", "FULL_ADDRESS"] == "12 Main St, Unit 4B, Springfield, IL, 62701"
@@ -0,0 +1,42 @@
+"""A run that dies during validation and is run again exports what an uninterrupted run does."""
+#%%
+import os
+
+import pytest
+
+from checkpoint import CHECKPOINTS_AVAILABLE, open_checkpoint
+from conftest import FakeUSPS
+from csv_transformer import modify_csv
+
+pytestmark = pytest.mark.skipif(not CHECKPOINTS_AVAILABLE, reason="checkpoints need fcntl")
+
+#%%
+def export(path, output_dir, usps, checkpoint=False, chunksize=0):
+    return modify_csv(path, usps_client=usps, address_cache=False, record_store=False, checkpoint=checkpoint,
+                      chunksize=chunksize, workers=1, output_dir=str(output_dir))
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+#%%
+@pytest.mark.parametrize("chunksize, fail_after", [(0, 30), (700, 30), (700, 130)])
+def test_resumed_run_matches_an_uninterrupted_run(donors, tmp_path, chunksize, fail_after):
+    usps = FakeUSPS()
+    uninterrupted = read_bytes(export(donors, tmp_path / "uninterrupted", usps, chunksize=chunksize))
+    root = str(tmp_path / "checkpoints")
+
+    with pytest.raises(ConnectionError):
+        export(donors, tmp_path / "export", FakeUSPS(fail_after=fail_after),
+               checkpoint=open_checkpoint(root, "donors", every=20), chunksize=chunksize)
+    assert os.listdir(root) == ["donors"]
+
+    resumed_usps = FakeUSPS()
+    resumed = export(donors, tmp_path / "export", resumed_usps,
+                     checkpoint=open_checkpoint(root, "donors", every=20), chunksize=chunksize)
+    assert read_bytes(resumed) == uninterrupted
+    # what the first run had validated was not sent again, and the finished
+    # run removed its checkpoint
+    assert resumed_usps.addresses_sent <= usps.addresses_sent - 5 * fail_after
+    assert os.listdir(root) == []
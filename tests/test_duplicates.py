@@ -0,0 +1,102 @@
+"""DuplicateIndex.flag on small frames, one record per row."""
+#%%
+import numpy as np
+import pandas as pd
+import pytest
+
+from matching import DuplicateIndex, soundex
+
+#%%
+DONOR = {"ROI_FAMILY_ID": "1", "FIRSTNAME": "John", "LASTNAME": "Smith", "SUFFIX": "", "ADDRESS1": "12 Main St",
+         "ADDRESS2": "", "ZIP_POSTALCODE": "62701", "V_STREET": "", "V_ZIP5": ""}
+
+
+def records(**rows):
+    # a frame of the columns match_keys reads, one row per keyword, labelled by it
+    return pd.DataFrame.from_dict(rows, orient="index", dtype=object)
+
+
+def flagged(**rows):
+    flags = DuplicateIndex().flag(records(**rows))
+    return flags[flags].index.tolist()
+
+
+def changed(base, **fields):
+    return {**base, **fields}
+
+#%%
+@pytest.mark.parametrize("name, key", [("Smith", "S530"), ("Smyth", "S530"), ("Smithe", "S530"),
+                                       ("Ashcraft", "A261"), ("Tymczak", "T522"), ("Pfister", "P236"),
+                                       ("Müller", "M460"), ("O'Brien", "O165"), ("Li", "L000"), ("2nd", "N300"),
+                                       ("-", "")])
+def test_soundex(name, key):
+    assert soundex(name) == key
+
+
+def test_same_person_under_another_family_is_flagged_after_the_first():
+    assert flagged(first=DONOR, smyth=changed(DONOR, ROI_FAMILY_ID="2", LASTNAME="Smyth"),
+                   third=changed(DONOR, ROI_FAMILY_ID="3", LASTNAME="SMITHE")) == ["smyth", "third"]
+
+
+def test_records_of_the_first_family_are_never_flagged():
+    assert flagged(first=DONOR, other=changed(DONOR, ROI_FAMILY_ID="2"),
+                   again=changed(DONOR, LASTNAME="Smyth")) == ["other"]
+
+
+def test_address_text_is_compared_without_case_spaces_or_trailing_periods():
+    assert flagged(first=DONOR, other=changed(DONOR, ROI_FAMILY_ID="2", ADDRESS1=" 12  main st. ",
+                                              ZIP_POSTALCODE="62701-1234")) == ["other"]
+
+
+def test_usps_street_and_zip_are_used_where_there_are_any():
+    validated = changed(DONOR, V_STREET="12 MAIN ST", V_ZIP5="62701")
+    assert flagged(first=validated, other=changed(validated, ROI_FAMILY_ID="2", ADDRESS1="12 Main Street",
+                                                  ZIP_POSTALCODE="")) == ["other"]
+
+
+def test_other_people_are_not_flagged():
+    assert flagged(first=DONOR,
+                   first_name=changed(DONOR, ROI_FAMILY_ID="2", FIRSTNAME="Jane"),
+                   last_name=changed(DONOR, ROI_FAMILY_ID="3", LASTNAME="Jones"),
+                   suffix=changed(DONOR, ROI_FAMILY_ID="4", SUFFIX="Jr."),
+                   unit=changed(DONOR, ROI_FAMILY_ID="5", ADDRESS2="Apt 4"),
+                   street=changed(DONOR, ROI_FAMILY_ID="6", ADDRESS1="14 Main St"),
+                   zip=changed(DONOR, ROI_FAMILY_ID="7", ZIP_POSTALCODE="62702")) == []
+
+
+def test_records_without_a_first_name_last_name_or_zip_are_not_flagged():
+    assert flagged(no_first=changed(DONOR, FIRSTNAME="."),
+                   no_first_again=changed(DONOR, FIRSTNAME="", ROI_FAMILY_ID="2"),
+                   no_last=changed(DONOR, LASTNAME="-"),
+                   no_last_again=changed(DONOR, LASTNAME="", ROI_FAMILY_ID="2"),
+                   no_zip=changed(DONOR, ZIP_POSTALCODE=""),
+                   no_zip_again=changed(DONOR, ZIP_POSTALCODE="", ROI_FAMILY_ID="2")) == []
+
+#%%
+@pytest.fixture(scope="module")
+def donors():
+    # many records sharing few names and addresses, in many families
+    rng = np.random.default_rng(11)
+    rows = 600
+    return pd.DataFrame({"ROI_FAMILY_ID": rng.integers(0, 40, rows).astype(str),
+                         "FIRSTNAME": rng.choice(["John", "Jon", "Mary", ""], rows),
+                         "LASTNAME": rng.choice(["Smith", "Smyth", "Jones"], rows),
+                         "SUFFIX": rng.choice(["", "Jr"], rows),
+                         "ADDRESS1": rng.choice(["12 Main St", "12 MAIN ST.", "4 Oak Ave"], rows),
+                         "ADDRESS2": rng.choice(["", "Apt 4"], rows),
+                         "ZIP_POSTALCODE": rng.choice(["62701", "62701-0001", "22201", ""], rows),
+                         "V_STREET": rng.choice(["", "", "12 MAIN ST"], rows),
+                         "V_ZIP5": ""}, index=rng.permutation(rows)).astype(object)
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 64, 599])
+def test_flags_do_not_depend_on_how_the_frame_is_split(donors, chunksize):
+    whole_index = DuplicateIndex()
+    whole = whole_index.flag(donors)
+    assert 0 < whole.sum() < len(donors)
+
+    index = DuplicateIndex()
+    chunked = pd.concat([index.flag(donors.iloc[start:start + chunksize])
+                         for start in range(0, len(donors), chunksize)])
+    pd.testing.assert_series_equal(chunked, whole)
+    assert len(index) == len(whole_index)
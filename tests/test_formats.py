@@ -0,0 +1,53 @@
+"""Reading earlier exports back in as uploads."""
+#%%
+import pandas as pd
+import pytest
+
+from csv_transformer import DERIVED_COLUMNS, OUTPUT_COLUMNS, clean_records, read_records, write_records
+
+pytest.importorskip("pyarrow")
+
+#%%
+@pytest.fixture
+def export():
+    # a typed export frame of two records, as finalize_records leaves it
+    df = pd.DataFrame({column: ["", ""] for column in OUTPUT_COLUMNS}, dtype=object)
+    df["ROI_FAMILY_ID"] = ["1", "2"]
+    df["FIRSTNAME"] = ["John", "Mary"]
+    df["LASTNAME"] = ["Smith", "Jones"]
+    df["COUNTRY"] = "US"
+    df["LARGESTGIFT"] = [1250.5, None]
+    df["LARGESTGIFTDATE"] = pd.to_datetime(["2021-03-04", "2020-12-31 10:30"], format="ISO8601")
+    df["AGE"] = pd.array([300, None], dtype="UInt16")
+    df["UNPARSED_VALUES"] = ["", '{"AGE": "n/a"}']
+    for column in OUTPUT_COLUMNS:
+        if column.endswith("_LEN"):
+            df[column] = 0
+    for column in ["REVIEW", "TRANSFORMED", "CHECK_EMAIL", "PREFIX_SUSPECT", "SUFFIX_SUSPECT", "HAD_AND",
+                   "POSSIBLE_DUPLICATE"]:
+        df[column] = False
+    return df
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_columnar_export_keeps_its_types(export, output_format, tmp_path):
+    path = str(tmp_path / f"export.{output_format}")
+    write_records(export, path, output_format=output_format)
+    df = read_records(path)
+    assert df["LARGESTGIFT"].dtype == "float64"
+    assert df["LARGESTGIFTDATE"].dtype == "datetime64[ns]"
+    assert pd.api.types.is_numeric_dtype(df["AGE"])
+    assert df["REVIEW"].tolist() == ["N", "N"]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet", "feather"])
+def test_export_can_be_cleaned_again(export, output_format, tmp_path):
+    path = str(tmp_path / f"export.{output_format}")
+    write_records(export, path, output_format=output_format)
+    df = clean_records(read_records(path))
+    assert not set(DERIVED_COLUMNS) & set(df.columns)
+    assert df["LARGESTGIFT"].tolist()[0] == 1250.5
+    # a time of day given with a date is kept
+    assert df["LARGESTGIFTDATE"].tolist() == [pd.Timestamp("2021-03-04"), pd.Timestamp("2020-12-31 10:30")]
+    assert df["AGE"].dtype == "UInt16" and df["AGE"].tolist()[0] == 300
+    assert df["UNPARSED_VALUES"].tolist() == ["", '{"AGE": "n/a"}']
@@ -0,0 +1,54 @@
+"""Incremental runs (RECORD_STORE_PATH) export exactly what a full run does."""
+#%%
+import pandas as pd
+import pytest
+
+from conftest import FakeUSPS
+from csv_transformer import modify_csv
+from record_store import RecordStore
+
+#%%
+def export(path, output_dir, usps=None, record_store=False, chunksize=0):
+    return modify_csv(path, usps_client=usps or FakeUSPS(), address_cache=False, record_store=record_store,
+                      checkpoint=False, chunksize=chunksize, workers=1, output_dir=str(output_dir))
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    yield store
+    store.close()
+
+#%%
+@pytest.mark.parametrize("chunksize", [0, 700])
+def test_second_run_reuses_every_row_and_matches_a_full_run(donors, tmp_path, store, chunksize):
+    full = read_bytes(export(donors, tmp_path / "full", chunksize=chunksize))
+    first = export(donors, tmp_path / "first", record_store=store, chunksize=chunksize)
+    assert read_bytes(first) == full
+
+    usps = FakeUSPS()
+    second = export(donors, tmp_path / "second", usps=usps, record_store=store, chunksize=chunksize)
+    assert read_bytes(second) == full
+    assert usps.addresses_sent == 0
+
+
+def test_changed_rows_are_transformed_again(donors, tmp_path, store):
+    export(donors, tmp_path / "first", record_store=store)
+
+    # a new name and a new street for a few donors
+    df = pd.read_csv(donors, dtype=str, keep_default_na=False, encoding="ISO-8859-1")
+    changed = df.index[5:300:50]
+    df.loc[changed, "FIRSTNAME"] = "Bartholomew"
+    df.loc[changed, "ADDRESS1"] = "1 Changed Rd"
+    path = str(tmp_path / "donors.csv")
+    df.to_csv(path, index=False, encoding="ISO-8859-1")
+
+    usps = FakeUSPS()
+    again = export(path, tmp_path / "again", usps=usps, record_store=store)
+    assert read_bytes(again) == read_bytes(export(path, tmp_path / "full"))
+    assert 0 < usps.addresses_sent <= len(changed)
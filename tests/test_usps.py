@@ -0,0 +1,160 @@
+"""The USPS clients against the local stub in benchmarks/usps_stub.py."""
+#%%
+import asyncio
+import threading
+
+import pytest
+
+from benchmarks.usps_stub import USPSStub
+from usps import ASYNC_AVAILABLE, NOT_VALIDATED, AdaptiveLimit, AsyncUSPSClient, CircuitBreaker, USPSClient
+
+needs_aiohttp = pytest.mark.skipif(not ASYNC_AVAILABLE, reason="AsyncUSPSClient needs aiohttp")
+
+#%%
+ADDRESSES = [("", f"{i} Main St", "", "Springfield", f"{22000 + i:05d}") for i in range(60)]
+
+
+def async_client(stub, **settings):
+    # quick to give up and quick to try again, so failures don't slow the tests
+    settings = {"max_concurrency": 8, "timeout": 1.0, "backoff": 0.01, "max_retries": 1, "reset_timeout": 0.2,
+                **settings}
+    return AsyncUSPSClient("TEST", api_url=stub.url, **settings)
+
+
+def validated(results):
+    # the stub echoes the street upper-cased and keeps the ZIP code
+    return [(result["Address2"], result["Zip5"]) for result in results] == \
+        [(street.upper(), zipcode) for _, street, _, _, zipcode in ADDRESSES]
+
+
+def not_validated(results):
+    return sum(result["VALIDATION_ERROR"] == NOT_VALIDATED for result in results)
+
+#%%
+def test_adaptive_limit_grows_on_fast_answers_and_halves_on_failures():
+    limit = AdaptiveLimit(initial=64, maximum=8, target_latency=10.0)
+    assert limit.limit == 8
+
+    async def answers(*outcomes):
+        limit.start()
+        for latency, ok in outcomes:
+            await limit.acquire()
+            await limit.release(latency, ok)
+
+    limit.limit = 2
+    asyncio.run(answers(*[(0.01, True)] * 5))
+    assert 3 < limit.limit <= 4
+    asyncio.run(answers((0.01, False)))
+    assert 1.5 < limit.limit <= 2
+    # a burst of failures halves it once per target_latency
+    asyncio.run(answers((0.01, False), (20.0, True)))
+    assert 1.5 < limit.limit <= 2
+    assert limit.in_flight == 0
+
+
+def test_circuit_breaker_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.trips == 1
+    assert not breaker.allow() and breaker.remaining() > 59
+
+
+def test_circuit_breaker_lets_one_trial_through_after_the_timeout():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+    breaker.failure()
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.trips == 2
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+#%%
+@needs_aiohttp
+def test_healthy_endpoint_validates_every_address():
+    with USPSStub() as stub:
+        client = async_client(stub)
+        seen = []
+        results = client.validate(ADDRESSES, on_results=lambda start, batch: seen.append((start, len(batch))))
+    assert validated(results)
+    assert sorted(seen) == [(start, 5) for start in range(0, len(ADDRESSES), 5)]
+    assert client.stats()["circuit_trips"] == 0 and client.not_validated_count == 0
+
+
+@needs_aiohttp
+def test_endpoint_down_trips_the_breaker_and_marks_addresses_not_validated():
+    with USPSStub() as stub:
+        stub.down = True
+        client = async_client(stub, reset_timeout=0.05)
+        results = client.validate(ADDRESSES)
+        requests = stub.requests
+    assert not_validated(results) == len(ADDRESSES) == client.not_validated_count
+    assert client.breaker.trips >= 1 and client.breaker.state == CircuitBreaker.OPEN
+    # the open circuit stopped most batches from being sent at all
+    assert requests < len(ADDRESSES) // 5
+    assert client.limit.limit < 8
+
+
+@needs_aiohttp
+@pytest.mark.parametrize("retry_pass", [True, False])
+def test_retry_pass_validates_batches_once_the_endpoint_recovers(retry_pass):
+    with USPSStub() as stub:
+        stub.down = True
+        # back up before the circuit lets the first trial request through
+        timer = threading.Timer(0.1, setattr, (stub, "down", False))
+        timer.start()
+        client = async_client(stub, reset_timeout=0.5, retry_pass=retry_pass)
+        try:
+            results = client.validate(ADDRESSES)
+        finally:
+            timer.cancel()
+    assert client.breaker.trips >= 1
+    if retry_pass:
+        assert validated(results) and not_validated(results) == 0
+        assert client.breaker.state == CircuitBreaker.CLOSED
+    else:
+        assert not_validated(results) == client.not_validated_count > 0
+        answered = [result for result in results if result["VALIDATION_ERROR"] != NOT_VALIDATED]
+        assert all(result["Zip5"] for result in answered)
+
+
+@needs_aiohttp
+def test_errors_and_slow_answers_are_retried():
+    with USPSStub(error_rate=0.3, slow_rate=0.1, slow_latency=0.5, seed=1) as stub:
+        client = async_client(stub, timeout=0.25, target_latency=0.1, max_retries=3, failure_threshold=50)
+        results = client.validate(ADDRESSES)
+        errors = stub.errors
+    assert errors > 0 and client.stats()["failures"] > 0
+    assert validated(results) and not_validated(results) == 0
+
+
+@needs_aiohttp
+def test_validate_inside_a_running_event_loop():
+    # as from a Jupyter notebook, which runs its own loop
+    async def notebook_cell(client):
+        return client.validate(ADDRESSES)
+
+    with USPSStub() as stub:
+        results = asyncio.run(notebook_cell(async_client(stub)))
+    assert validated(results)
+
+#%%
+def test_thread_client_marks_addresses_not_validated_while_down():
+    with USPSStub() as stub:
+        stub.down = True
+        client = USPSClient("TEST", api_url=stub.url, max_workers=4, max_retries=1, backoff=0.01, timeout=1.0)
+        try:
+            down = client.validate(ADDRESSES)
+            stub.down = False
+            up = client.validate(ADDRESSES)
+        finally:
+            client.close()
+    assert not_validated(down) == len(ADDRESSES)
+    assert validated(up) and not_validated(up) == 0
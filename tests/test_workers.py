@@ -0,0 +1,29 @@
+"""Runs that prepare records in a process pool export what a serial run does."""
+#%%
+import pytest
+
+import csv_transformer
+from conftest import FakeUSPS
+from csv_transformer import modify_csv
+from metrics import read_stages
+
+#%%
+def export(path, output_dir, workers, chunksize=0):
+    return modify_csv(path, usps_client=FakeUSPS(), address_cache=False, record_store=False, checkpoint=False,
+                      chunksize=chunksize, workers=workers, output_dir=str(output_dir))
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+#%%
+@pytest.mark.parametrize("chunksize", [0, 700])
+def test_two_workers_export_what_one_does(donors, tmp_path, monkeypatch, chunksize):
+    # partitions this small would normally be prepared in this process
+    monkeypatch.setattr(csv_transformer, "MIN_PARTITION_ROWS", 100)
+    serial = export(donors, tmp_path / "serial", workers=1, chunksize=chunksize)
+    parallel = export(donors, tmp_path / "parallel", workers=2, chunksize=chunksize)
+    assert read_bytes(parallel) == read_bytes(serial)
+    stages = {stage["stage"] for stage in read_stages(parallel)["stages"]}
+    assert "prepare" in stages and "clean" not in stages
@@ -0,0 +1,491 @@
+#%%
+import asyncio
+import json
+import threading
+import time
+import xml.etree.ElementTree as ET # needed to parse USPS API returned XML
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.sax.saxutils import escape
+
+import requests # needed for USPS API
+from requests.adapters import HTTPAdapter
+
+from metrics import logger
+
+# aiohttp is only needed for AsyncUSPSClient; USPSClient works without it
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# whether AsyncUSPSClient can be used
+ASYNC_AVAILABLE = aiohttp is not None
+
+#%%
+USPS_API_URL = "https://secure.shippingapis.com/ShippingAPI.dll"
+
+# the Verify API accepts at most 5 <Address> elements per request
+MAX_BATCH_SIZE = 5
+
+# message written to VALIDATION_ERROR when USPS could not match an address
+VALIDATION_ERROR = "Check original address for errors"
+
+# message written to VALIDATION_ERROR when USPS never answered for an address
+# (request failures, circuit open); these results are not cached, so the
+# address is validated again on the next run
+NOT_VALIDATED = "Not validated, USPS did not respond"
+
+# fields returned for every address, in column order
+RESULT_FIELDS = ["Address2", "Address3", "City", "State", "Zip5", "Zip4", "VALIDATION_ERROR"]
+
+# HTTP status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+#%%
+class RateLimiter:
+    """Spaces out request starts so no more than `rate` begin per second across all threads."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def reserve(self):
+        # claim the next start slot and return the seconds until it comes up
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        return start - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LatencyRecorder:
+    """Latency of the most recent `size` requests, with request and failure counts."""
+
+    def __init__(self, size=100_000):
+        self.latencies = deque(maxlen=size)
+        self.requests = 0
+        self.failures = 0
+
+    def record(self, seconds, ok=True):
+        self.latencies.append(seconds)
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+
+    def percentiles(self, points=(50, 90, 99)):
+        # nearest-rank percentiles in milliseconds, None before any request
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {f"p{point}_ms": None for point in points}
+        return {f"p{point}_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * point / 100))] * 1000, 1)
+                for point in points}
+
+    def stats(self):
+        return {"requests": self.requests, "failures": self.failures, **self.percentiles()}
+
+
+#%%
+class VerifyClient:
+    """Builds and parses USPS Verify requests; subclasses decide how they are sent."""
+
+    def __init__(self, user_id, api_url=USPS_API_URL, batch_size=MAX_BATCH_SIZE, rate_limit=None,
+                 max_retries=3, backoff=0.5, timeout=10):
+        self.user_id = user_id
+        self.api_url = api_url
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.latency = LatencyRecorder()
+
+    def batches(self, addresses):
+        addresses = list(addresses)
+        return [addresses[i:i + self.batch_size] for i in range(0, len(addresses), self.batch_size)]
+
+    def build_request(self, batch):
+        # batch is a list of (address1, address2, address3, city, zip5) tuples;
+        # the position in the batch is used as the Address ID
+        parts = [f"<AddressValidateRequest USERID='{escape(str(self.user_id))}'>"]
+        for address_id, (address1, address2, _, city, zip5) in enumerate(batch):
+            parts.append(f"<Address ID='{address_id}'>"
+                         f"<Address1>{escape(str(address1))}</Address1>"
+                         f"<Address2>{escape(str(address2))}</Address2>"
+                         f"<City>{escape(str(city))}</City>"
+                         f"<State></State>"
+                         f"<Zip5>{escape(str(zip5))}</Zip5>"
+                         f"<Zip4></Zip4>"
+                         f"</Address>")
+        parts.append("</AddressValidateRequest>")
+        return "".join(parts)
+
+    def parse_response(self, text, batch):
+        parsed_response = ET.fromstring(text)
+
+        # an <Error> at the root means the whole request was rejected
+        if parsed_response.tag == "Error":
+            return [self.error_result(address[2]) for address in batch]
+
+        # map each <Address> element back to its batch position by ID
+        by_id = {}
+        for element in parsed_response.findall("Address"):
+            by_id[element.get("ID")] = element
+
+        results = []
+        for address_id, address in enumerate(batch):
+            element = by_id.get(str(address_id))
+            if element is None:
+                results.append(self.error_result(address[2]))
+                continue
+
+            result = {
+                "Address2": element.findtext("Address2"),
+                "Address3": address[2],
+                "City": element.findtext("City"),
+                "State": element.findtext("State"),
+                "Zip5": element.findtext("Zip5"),
+                "Zip4": element.findtext("Zip4"),
+                "VALIDATION_ERROR": None,
+            }
+            if element.find(".//Error") is not None:
+                result["VALIDATION_ERROR"] = VALIDATION_ERROR
+            results.append(result)
+        return results
+
+    @staticmethod
+    def error_result(address3):
+        result = dict.fromkeys(RESULT_FIELDS)
+        result["Address3"] = address3
+        result["VALIDATION_ERROR"] = VALIDATION_ERROR
+        return result
+
+    @staticmethod
+    def not_validated(address3):
+        result = dict.fromkeys(RESULT_FIELDS)
+        result["Address3"] = address3
+        result["VALIDATION_ERROR"] = NOT_VALIDATED
+        return result
+
+    def stats(self):
+        # request counts and latency percentiles, for the validation log line
+        return self.latency.stats()
+
+
+class USPSClient(VerifyClient):
+    """Validates addresses against the USPS Verify API.
+
+    Addresses are packed `batch_size` to a request, requests are sent from
+    `max_workers` threads over one pooled session, and transient failures are
+    retried with exponential backoff. Addresses USPS never answered for are
+    marked NOT_VALIDATED.
+    """
+
+    def __init__(self, user_id, api_url=USPS_API_URL, batch_size=MAX_BATCH_SIZE, max_workers=8,
+                 rate_limit=None, max_retries=3, backoff=0.5, timeout=10):
+        super().__init__(user_id, api_url=api_url, batch_size=batch_size, rate_limit=rate_limit,
+                         max_retries=max_retries, backoff=backoff, timeout=timeout)
+        self.max_workers = max(1, max_workers)
+
+        # one connection per worker thread, reused for every request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send_batch(self, batch):
+        params = {"API": "Verify", "XML": self.build_request(batch)}
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+                if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    self.latency.record(time.perf_counter() - start, ok=False)
+                    time.sleep(self.backoff * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                results = self.parse_response(response.text, batch)
+                self.latency.record(time.perf_counter() - start)
+                return results
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.latency.record(time.perf_counter() - start, ok=False)
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+                    continue
+                logger.warning(json.dumps({"event": "usps_request_failed", "error": str(e)}))
+            except (requests.exceptions.RequestException, ET.ParseError) as e:
+                self.latency.record(time.perf_counter() - start, ok=False)
+                logger.warning(json.dumps({"event": "usps_request_failed", "error": str(e)}))
+            break
+
+        return [self.not_validated(address[2]) for address in batch]
+
+    def validate(self, addresses, on_results=None):
+        """Validate a list of (address1, address2, address3, city, zip5) tuples.
+
+        Returns one dict of RESULT_FIELDS per address, in input order.
+        on_results, if given, is called from this thread as
+        on_results(start, results) with each batch's results as they come
+        back, start being the position of the batch's first address.
+        """
+        batches = self.batches(addresses)
+        batch_results = [None] * len(batches)
+
+        if self.max_workers == 1 or len(batches) <= 1:
+            for i, batch in enumerate(batches):
+                batch_results[i] = self.send_batch(batch)
+                if on_results is not None:
+                    on_results(i * self.batch_size, batch_results[i])
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.send_batch, batch): i for i, batch in enumerate(batches)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    batch_results[i] = future.result()
+                    if on_results is not None:
+                        on_results(i * self.batch_size, batch_results[i])
+
+        return [result for results in batch_results for result in results]
+
+    def close(self):
+        self.session.close()
+
+
+#%%
+class AdaptiveLimit:
+    """Concurrency limit that adapts to the endpoint (additive increase, multiplicative decrease).
+
+    The limit grows by one for every `limit` requests answered within
+    `target_latency` seconds, and halves on a failure or a slower answer, at
+    most once per `target_latency` so one burst of slow answers halves it once.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, target_latency=1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self._decreased = 0.0
+        self._condition = None
+
+    def start(self):
+        # asyncio primitives belong to one event loop; every run gets its own
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency=None, ok=True):
+        # latency None gives the slot back without counting a request
+        async with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if latency is None:
+                pass
+            elif not ok or latency > self.target_latency:
+                if now - self._decreased >= self.target_latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Stops requests to an endpoint that keeps failing.
+
+    After `threshold` failures in a row the circuit opens and requests fail
+    straight away. Once `reset_timeout` seconds have passed one trial request
+    is let through: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.trips = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.remaining() == 0:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def remaining(self):
+        # seconds until an open circuit lets a trial request through
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+            self.trips += 1
+
+
+class AsyncUSPSClient(VerifyClient):
+    """Validates addresses against the USPS Verify API from one asyncio event loop.
+
+    Each request has a `timeout`. How many requests are in flight adapts to
+    the endpoint (see AdaptiveLimit, up to `max_concurrency`), and a circuit
+    breaker stops sending once it keeps failing. Batches that got no answer
+    are sent again in a retry pass at the end of the run, once the breaker
+    lets requests through; addresses still without an answer are marked
+    NOT_VALIDATED. Needs aiohttp.
+    """
+
+    def __init__(self, user_id, api_url=USPS_API_URL, batch_size=MAX_BATCH_SIZE, max_concurrency=32,
+                 initial_concurrency=4, target_latency=1.0, rate_limit=None, max_retries=3, backoff=0.5,
+                 timeout=10, failure_threshold=5, reset_timeout=30.0, retry_pass=True):
+        if aiohttp is None:
+            raise ImportError("AsyncUSPSClient needs aiohttp installed")
+        super().__init__(user_id, api_url=api_url, batch_size=batch_size, rate_limit=rate_limit,
+                         max_retries=max_retries, backoff=backoff, timeout=timeout)
+        self.limit = AdaptiveLimit(initial=initial_concurrency, maximum=max_concurrency,
+                                   target_latency=target_latency)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.retry_pass = retry_pass
+        self.not_validated_count = 0
+
+    async def send_request(self, session, params, batch):
+        # one attempt; raises for anything but a parsed answer
+        delay = self.rate_limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with session.get(self.api_url, params=params) as response:
+            text = await response.text()
+            response.raise_for_status()
+        return self.parse_response(text, batch)
+
+    async def send_batch(self, session, batch):
+        # the batch's results, or None if USPS never answered
+        params = {"API": "Verify", "XML": self.build_request(batch)}
+
+        for attempt in range(self.max_retries + 1):
+            await self.limit.acquire()
+            if not self.breaker.allow():
+                await self.limit.release()
+                return None
+            start = time.perf_counter()
+            ok = False
+            try:
+                results = await self.send_request(session, params, batch)
+                ok = True
+                return results
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUS:
+                    logger.warning(json.dumps({"event": "usps_request_failed", "error": str(e)}))
+                    return None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            except ET.ParseError as e:
+                logger.warning(json.dumps({"event": "usps_request_failed", "error": f"bad response: {e}"}))
+                return None
+            finally:
+                latency = time.perf_counter() - start
+                self.latency.record(latency, ok)
+                if ok:
+                    self.breaker.success()
+                else:
+                    self.breaker.failure()
+                await self.limit.release(latency, ok)
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        return None
+
+    async def validate_async(self, addresses, on_results=None):
+        batches = self.batches(addresses)
+        self.limit.start()
+        connector = aiohttp.TCPConnector(limit=self.limit.maximum)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def send(i):
+                results = await self.send_batch(session, batches[i])
+                if results is not None and on_results is not None:
+                    on_results(i * self.batch_size, results)
+                return results
+
+            answers = await asyncio.gather(*(send(i) for i in range(len(batches))))
+
+            failed = [i for i, answer in enumerate(answers) if answer is None]
+            for _ in range(self.max_retries + 1 if self.retry_pass else 0):
+                if not failed:
+                    break
+                # wait out an open circuit, then send one batch on its own as
+                # the trial; the rest only follow if it gets an answer
+                await asyncio.sleep(self.breaker.remaining())
+                answers[failed[0]] = await send(failed[0])
+                if answers[failed[0]] is not None:
+                    retried = await asyncio.gather(*(send(i) for i in failed[1:]))
+                    for i, result in zip(failed[1:], retried):
+                        answers[i] = result
+                failed = [i for i in failed if answers[i] is None]
+
+        results = []
+        for batch, answer in zip(batches, answers):
+            if answer is None:
+                answer = [self.not_validated(address[2]) for address in batch]
+                self.not_validated_count += len(batch)
+            results += answer
+        return results
+
+    def validate(self, addresses, on_results=None):
+        """Validate a list of (address1, address2, address3, city, zip5) tuples.
+
+        Returns one dict of RESULT_FIELDS per address, in input order.
+        on_results, if given, is called as on_results(start, results) with
+        the results of each batch USPS answers, as it answers, start being
+        the position of the batch's first address.
+
+        Called from a thread that is already running an event loop (a Jupyter
+        notebook, an async server), the requests go out from a loop of their
+        own in a worker thread, and on_results is called from that thread.
+        """
+        addresses = list(addresses)
+        if not addresses:
+            return []
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.validate_async(addresses, on_results))
+        # asyncio.run can't start a loop inside a running one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.validate_async(addresses, on_results)).result()
+
+    def stats(self):
+        return {**super().stats(), "concurrency": round(self.limit.limit, 1), "circuit": self.breaker.state,
+                "circuit_trips": self.breaker.trips, "not_validated": self.not_validated_count}
+
+    def close(self):
+        # sessions are opened and closed by each validate call
+        pass